@@ -8,10 +8,24 @@ import copy
 import os
 import re
 import calendar
+import warnings
+import sqlite3
+import pickle
+import hashlib
+import json
+import time
 import statsmodels.api as sm
+import scipy.sparse as sp
 from clef.code import *
 from glob import glob
 
+########
+#Catalogue with time bounds of CMIP6 files (see catalogueFiles)
+CATALOGUE = os.path.join(os.path.expanduser('~'), '.cache', 'ACCESS_catalogue.db')
+#Local mirror of clef search results (see cachedSearch) and clef session shared by all searches in this process
+SEARCH_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'ACCESS_search.db')
+CLEF_SESSION = {}
+
 ########
 #Defining functions
 
@@ -28,16 +42,17 @@ def searchACCESS(var, model, freq, exp, **kwargs):
     variant - str, experiment run to be search
     time_frame - list, time period of interest given to the nearest decade 
     (e.g., if interested in the period between 1991 and 2008, then use: [1990, 2000, 2010]
+    period - list, start and end dates of period of interest (e.g., ['1991-01', '2008-12']). Only files 
+    overlapping this period are returned
+    db_path - str, file path to the catalogue where the time bounds of each file are stored. Default is CATALOGUE
+    refresh - boolean, if True files in the data folder are listed again and added to the catalogue
+    cache_path, ttl, offline - options passed to cachedSearch
     
     Returns:
     files - list, includes file paths for all datasets that meet search requirements
     within the specified time period
     '''
     
-    #Creating a session and connecting to database
-    db = connect()
-    s = Session()
-    
     #Extract variables from kwargs
     if 'variant' in kwargs.keys():
         variant = kwargs.get('variant')
@@ -47,29 +62,246 @@ def searchACCESS(var, model, freq, exp, **kwargs):
     #Creating dictionary to perform search using clef
     search_dict = {'variable_id': var, 'model': model, 'frequency': freq, 
               'experiment_id':exp, 'variant_label': variant}
-    df = search(s, project = 'CMIP6', latest = True, **search_dict)
+    #Search results are read from the local mirror if available
+    cache_args = dict([(k, kwargs.get(k)) for k in ['cache_path', 'ttl', 'offline'] if k in kwargs.keys()])
+    df = cachedSearch(project = 'CMIP6', latest = True, **cache_args, **search_dict)
     
     #If experiment runs (variants) need to be search, use the code below
     # sorted([re.search('r[0-9]{,2}i[0-9]{,2}p[0-9]{,2}f[0-9]{,2}', 
     #                   f).group() for f in df['path']])
     
-    if 'time_frame' in kwargs.keys():
-        time_frame = kwargs.get('time_frame')
-        #Creating a file path list of all available datasets meeting search
-        #parameters
+    if 'time_frame' in kwargs.keys() or 'period' in kwargs.keys():
+        if 'period' in kwargs.keys():
+            s_time, e_time = kwargs.get('period')
+        else:
+            time_frame = kwargs.get('time_frame')
+            s_time, e_time = str(time_frame[0]), str(time_frame[-1])
+        db_path = kwargs.get('db_path', CATALOGUE)
+        #Folder containing all available datasets meeting search parameters
         folder_path = [f for f in df['path'] if variant in f]
-        filenames = sorted(glob(os.path.join(folder_path[0], '*.nc')))
+        
+        #Time bounds of files are added to the catalogue the first time a folder is searched
+        files = queryCatalogue(db_path = db_path, folder = folder_path[0])
+        if len(files) == 0 or kwargs.get('refresh', False):
+            filenames = sorted(glob(os.path.join(folder_path[0], '*.nc')))
+            catalogueFiles(filenames, db_path = db_path, variable = var, variant = variant, 
+                           frequency = freq)
     
-        #Subsetting list to select only files within the time period of interest
-        files = []
-        for yr in time_frame:
-            files.append([f for f in filenames if str(yr) in f][0])
+        #Selecting only files within the time period of interest
+        files = queryCatalogue(s_time, e_time, db_path = db_path, folder = folder_path[0])
     
     else:
         files = [os.path.join(df['path'][0], list(df['filename'][0])[0])]
     
     return files
 
+########
+#Runs a clef search and keeps results in a local SQLite mirror, so identical searches do not query the clef database
+def cachedSearch(cache_path = SEARCH_CACHE, ttl = 30, offline = False, **constraints):
+    '''
+    Inputs:
+    cache_path - str, file path to the SQLite mirror where search results are stored. Default is SEARCH_CACHE. 
+    A local stand-in database created with writeSearch can also be used
+    ttl - numeric, number of days search results are valid for. Default is 30
+    offline - boolean, if True results are only read from the mirror (regardless of their age) and the clef 
+    database is not used
+    constraints - search constraints passed to clef search (e.g., project, latest, variable_id, model)
+    
+    Returns:
+    df - data frame, with search results
+    '''
+    cached = readSearch(cache_path, constraints)
+    if cached is not None and (offline or time.time()-cached[1] < ttl*86400):
+        return cached[0]
+    if offline:
+        raise ValueError(f'Search results are not available in {cache_path}: {constraints}')
+    
+    #Connecting to the clef database only once per process
+    if 'session' not in CLEF_SESSION.keys():
+        db = connect()
+        CLEF_SESSION['session'] = Session()
+    df = search(CLEF_SESSION['session'], **constraints)
+    writeSearch(cache_path, constraints, df)
+    
+    return df
+
+########
+#Reads search results from the local mirror
+def readSearch(cache_path, constraints):
+    '''
+    Inputs:
+    cache_path - str, file path to the SQLite mirror where search results are stored
+    constraints - dictionary, search constraints used as key
+    
+    Returns:
+    Tuple with data frame and time (in seconds) when results were stored. None if results are not in the mirror
+    '''
+    if not os.path.isfile(cache_path):
+        return None
+    key = hashlib.sha1(json.dumps(constraints, sort_keys = True, default = str).encode()).hexdigest()
+    con = connectSearch(cache_path)
+    row = con.execute('SELECT result, created FROM searches WHERE key = ?', (key,)).fetchone()
+    con.close()
+    if row is None:
+        return None
+    
+    return pickle.loads(row[0]), row[1]
+
+########
+#Saves search results to the local mirror
+def writeSearch(cache_path, constraints, df):
+    '''
+    Inputs:
+    cache_path - str, file path to the SQLite mirror where search results are stored
+    constraints - dictionary, search constraints used as key
+    df - data frame, search results to be stored
+    '''
+    key = hashlib.sha1(json.dumps(constraints, sort_keys = True, default = str).encode()).hexdigest()
+    con = connectSearch(cache_path)
+    with con:
+        con.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)', 
+                    (key, json.dumps(constraints, sort_keys = True, default = str), time.time(), 
+                     pickle.dumps(df)))
+    con.close()
+
+########
+#Opens the search mirror database, creating it if it does not exist
+def connectSearch(cache_path = SEARCH_CACHE):
+    '''
+    Inputs:
+    cache_path - str, file path to the SQLite mirror where search results are stored. Default is SEARCH_CACHE
+    
+    Returns:
+    con - connection to database
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok = True)
+    con = sqlite3.connect(cache_path)
+    con.execute('''CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, constraints TEXT, created REAL, 
+                   result BLOB)''')
+    
+    return con
+
+########
+#Stores the time bounds of netcdf files in a local catalogue so they can be searched by date without opening files
+def catalogueFiles(filelist, db_path = CATALOGUE, **kwargs):
+    '''
+    Inputs:
+    filelist - list, filepaths of netcdf files to be added to the catalogue
+    db_path - str, file path to the SQLite database where the catalogue is stored. Default is CATALOGUE
+    
+    Optional inputs:
+    variable - str, code for variable included in files. If not provided, it is taken from the CMIP6 file name
+    variant - str, experiment run. If not provided, it is taken from the CMIP6 file name
+    frequency - str, frequency of the data. If not provided, the CMIP6 table in the file name is used
+    
+    Returns:
+    n - int, number of files added or updated in the catalogue. Files already catalogued are only read again if 
+    they have been modified
+    '''
+    con = connectCatalogue(db_path)
+    known = dict(con.execute('SELECT path, mtime FROM files').fetchall())
+    
+    rows = []
+    for f in filelist:
+        f = os.path.abspath(f)
+        mtime = os.path.getmtime(f)
+        if known.get(f) == mtime:
+            continue
+        #CMIP6 file names: variable_table_model_experiment_variant_grid_dates.nc
+        parts = os.path.basename(f)[:-3].split('_') + [None]*5
+        #Only the first and last time steps are read from the file header
+        s_time, e_time = None, None
+        with nc.Dataset(f) as ds:
+            if 'time' in ds.variables and ds.variables['time'].size > 0:
+                t = ds.variables['time']
+                dates = nc.num2date([t[0], t[-1]], t.units, getattr(t, 'calendar', 'standard'))
+                s_time, e_time = [d.strftime('%Y-%m-%d %H:%M:%S') for d in dates]
+        rows.append((f, os.path.dirname(f), kwargs.get('variable', parts[0]), kwargs.get('variant', parts[4]),
+                     kwargs.get('frequency', parts[1]), s_time, e_time, mtime))
+    
+    with con:
+        con.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    con.close()
+    
+    return len(rows)
+
+########
+#Searches the catalogue for files overlapping a time period
+def queryCatalogue(start = None, end = None, db_path = CATALOGUE, **kwargs):
+    '''
+    Inputs:
+    start - str, start of period of interest (e.g., '1991', '1991-01' or '1991-01-15'). If None, files are not 
+    filtered by start date
+    end - str, end of period of interest. Partial dates include the whole year or month. If None, files are not 
+    filtered by end date
+    db_path - str, file path to the SQLite database where the catalogue is stored. Default is CATALOGUE
+    
+    Optional inputs:
+    folder, variable, variant, frequency - str, only files matching these values are returned
+    
+    Returns:
+    files - list, file paths sorted by their first time step
+    '''
+    query = 'SELECT path FROM files WHERE 1 = 1'
+    params = []
+    for key in ['folder', 'variable', 'variant', 'frequency']:
+        if kwargs.get(key) is not None:
+            query += f' AND {key} = ?'
+            params.append(os.path.abspath(kwargs[key]) if key == 'folder' else kwargs[key])
+    #Partial dates are completed so the whole year or month is included
+    if end is not None:
+        query += ' AND start_time <= ?'
+        params.append(str(end) + '0000-12-31 23:59:59'[len(str(end)):])
+    if start is not None:
+        query += ' AND end_time >= ?'
+        params.append(str(start) + '0000-01-01 00:00:00'[len(str(start)):])
+    query += ' ORDER BY start_time, path'
+    
+    con = connectCatalogue(db_path)
+    files = [row[0] for row in con.execute(query, params)]
+    con.close()
+    
+    return files
+
+########
+#Opens the catalogue database, creating it if it does not exist
+def connectCatalogue(db_path = CATALOGUE):
+    '''
+    Inputs:
+    db_path - str, file path to the SQLite database where the catalogue is stored. Default is CATALOGUE
+    
+    Returns:
+    con - connection to database
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok = True)
+    con = sqlite3.connect(db_path)
+    con.execute('''CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, folder TEXT, variable TEXT, 
+                   variant TEXT, frequency TEXT, start_time TEXT, end_time TEXT, mtime REAL)''')
+    con.execute('CREATE INDEX IF NOT EXISTS files_folder ON files (folder, start_time)')
+    con.execute('CREATE INDEX IF NOT EXISTS files_search ON files (variable, frequency, variant, start_time)')
+    
+    return con
+
+########
+#Checks if the period covered by a file (based on its CMIP6 file name) overlaps with the period of interest
+def fileInPeriod(filepath, s_time, e_time):
+    '''
+    Inputs:
+    filepath - str, filepath of CMIP6 file, which ends with the dates it covers (e.g., _201501-202412.nc)
+    s_time - str, start of period of interest (YYYY-MM)
+    e_time - str, end of period of interest (YYYY-MM)
+    
+    Returns:
+    Boolean, True if the file overlaps the period of interest or if its dates cannot be identified
+    '''
+    dates = re.search(r'_([0-9]{4,8})-([0-9]{4,8})\.nc$', os.path.basename(filepath))
+    if dates is None:
+        return True
+    #Comparing year and month only
+    f_start = (dates.group(1) + '01')[:6]
+    f_end = (dates.group(2) + '12')[:6]
+    return f_start <= e_time.replace('-', '') and f_end >= s_time.replace('-', '')
+
 ########
 #Correcting longitude values in a data array so they are between -180 and +180 degrees
 def corrlong(array):
@@ -81,22 +313,51 @@ def corrlong(array):
     Data array with corrected longitude values.
     '''
     
-    #Making a deep copy of original longitude values in the array being corrected
+    #Values changed from 0-360 to between -180 and +180. A new array is created so original coordinates are not modified
     lon = array['longitude'][0].values
-    
-    #Values changed from 0-360 to between -180 and +180.
-    lon[np.where(lon > 180)] = lon[np.where(lon >180)]-360
+    lon = np.where(lon > 180, lon-360, lon)
     
     #Assigning corrected longitudes and latitude values to i and j, which are index based
-    array.coords['i'] = lon
-    array.coords['j'] = array['latitude'][:,0].values
+    array = array.assign_coords(i = lon, j = array['latitude'][:,0].values)
     
     #Removing latitude and longitude dimensions and renaming i and j dimensions
     array = array.drop(('latitude', 'longitude'))
     array = array.rename(({'i':'longitude', 'j':'latitude'}))
     
     #Longitude values must be sorted from smallest to largest prior to plotting
-    array = array.sortby(array.longitude)
+    array = recentreLon(array, 'longitude', lon)
+    
+    return array
+
+########
+#Sorts longitudes from smallest to largest using a circular shift, so data is not reordered element by element
+def recentreLon(array, dim, lon):
+    '''
+    Inputs:
+    array - data frame, to be shifted
+    dim - str, name of the longitude dimension
+    lon - numpy array, corrected longitude values (between -180 and +180) in the original order
+    
+    Returns:
+    array - data frame, with longitudes sorted from smallest to largest. If the array is dask backed, no data is copied 
+    until it is computed. Original coordinates are not modified
+    '''
+    #Position of the smallest longitude, which becomes the first value
+    shift = int(np.argmin(lon))
+    new_lon = np.concatenate([lon[shift:], lon[:shift]])
+    
+    #If corrected longitudes are not a circular shift of sorted values, sort them instead
+    if np.any(np.diff(new_lon) <= 0):
+        return array.sortby(dim)
+    
+    #Join the two contiguous parts of the array in the new order
+    if shift > 0:
+        kwargs = {'coords': 'minimal', 'compat': 'override'}
+        if isinstance(array, xr.Dataset):
+            kwargs['data_vars'] = 'minimal'
+        array = xr.concat([array.isel({dim: slice(shift, None)}), array.isel({dim: slice(0, shift)})], 
+                          dim = dim, **kwargs)
+    array = array.assign_coords({dim: new_lon})
     
     return array
 
@@ -119,59 +380,71 @@ def loadData(filelist, var_name, SO = True, weights = False, **kwargs):
     da - data frame, includes data for variable, time period and habitat of interest
     '''
     
-    #Empty variable to store data frames
-    var = []
-    
-    if len(filelist) > 1:
-        #Looping through files and stacking them
-        for f in filelist:
-            var.append(xr.open_dataset(f, mask_and_scale = True))
-        #Concatenating files across time dimension
-        var = xr.concat(var, dim = 'time')
-    else:
-        var = xr.open_dataset(filelist[0], mask_and_scale = True)
-        if weights == True:
-            var = var[var_name][0]
-    
+    #Time period of interest
     if 'years' in kwargs.keys() and 'months' in kwargs.keys():
         years = kwargs.get('years')
         months = kwargs.get('months')
-        #Selecting data for the time period of interest
         s_time = f'{str(years[0])}-{str(months[0])}'
         e_time = f'{str(years[-1])}-{str(months[-1])}'
-        
-        var = var[var_name].sel(time = slice(s_time, e_time))
+        #Files that do not overlap the period of interest are not opened
+        filelist = [f for f in filelist if fileInPeriod(f, s_time, e_time)]
+    else:
+        s_time = None
+        e_time = None
     
-    if 'depth_range' in kwargs.keys():
-        if 'lev' in var.coords:
+    #Subsets are applied to each file as it is opened
+    def _subset(ds):
+        ds = ds[[var_name]]
+        if s_time is not None and 'time' in ds.dims:
+            #Selecting data for the time period of interest
+            ds = ds.sel(time = slice(s_time, e_time))
+        if 'depth_range' in kwargs.keys() and 'lev' in ds.coords:
             depths = kwargs.get('depth_range')
             #Subsetting data based on depths of interest
-            var = var.sel(lev = slice(depths[0], depths[-1]))
-        else:
-            var = var
-        
-    if type(var) == xr.core.dataset.Dataset:
-        var = var[var_name]
+            ds = ds.sel(lev = slice(depths[0], depths[-1]))
+        if SO == True:
+            #Select the SO using the latitudes that are assigned to the j dimension in corrlong
+            lats = ds['latitude'][:, 0].values
+            ds = ds.isel(j = np.where((lats >= -90) & (lats <= -30))[0])
+        return ds
+    
+    #Checking if files have a time dimension (e.g., areacello and thkcello do not)
+    with xr.open_dataset(filelist[0]) as ds:
+        has_time = 'time' in ds[var_name].dims
+    
+    if len(filelist) > 1 and has_time:
+        #Opening all files in parallel and stacking them across time dimension
+        var = xr.open_mfdataset(filelist, preprocess = _subset, mask_and_scale = True, parallel = True,
+                                combine = 'nested', concat_dim = 'time', coords = 'minimal', 
+                                compat = 'override')
+    else:
+        var = _subset(xr.open_dataset(filelist[0], mask_and_scale = True))
+    var = var[var_name]
+    if weights == True and has_time:
+        #Only one time slice is needed for weights
+        var = var.isel(time = 0)
         
     #Apply latitude and longitude corrections
     var = corrlong(var)
     
-    if SO == True:
-        #Select the SO
-        var = var.sel(latitude = slice(-90, -30))
-    
     #Return variable with variable of interest for specified time frame, depth and area
     return var
 
 ########
 #Creates a mask from a netcdf file that can be applied to a data array
-def creatingMask(mask_file):
+def creatingMask(mask_file, sparse = False, weights = None):
     '''
     Inputs:
     maskfile - str, filepath for the location of mask. Must be a netcdf file
+    
+    Optional inputs:
+    sparse - boolean, if True a sparse regions x cells operator is returned instead of one mask per region. 
+    This operator allows statistics for all regions to be calculated in a single pass over the data
+    weights - data frame, containing weights (e.g., area or volume) to be folded into the sparse operator. 
+    Weights can have more dimensions than the mask (e.g., lev). Only used if sparse is True
             
     Returns:
-    mask_reg - data frame, to mask data
+    mask_reg - data frame, to mask data. If sparse is True, this is a dictionary containing the sparse operator
     regionNames - list, containing names of regions within mask
     '''
     
@@ -181,6 +454,11 @@ def creatingMask(mask_file):
     #Applying mask
     #Getting region names from mask
     regionNames = sorted(set(mask.region.values))
+    
+    #Build a single operator for all regions if requested
+    if sparse == True:
+        mask_reg = regionOperator(mask, regionNames, weights = weights)
+        return mask_reg, regionNames
 
     #Subsetting shapefiles into regions
     #Initialise dictionary that will contain sector limits
@@ -192,6 +470,155 @@ def creatingMask(mask_file):
 
     return mask_reg, regionNames
 
+########
+#Creates a sparse regions x cells operator from a mask with a region dimension
+def regionOperator(mask, regionNames, weights = None):
+    '''
+    Inputs:
+    mask - data frame, containing a region dimension. Cells within a region must be set to 1, all other cells to NA or 0
+    regionNames - list, containing names of regions to be included in the operator
+    
+    Optional inputs:
+    weights - data frame, containing weights to be folded into the operator. Dimensions not included in the mask 
+    (e.g., lev) are added to the operator as extra cells
+            
+    Returns:
+    reg_op - dictionary, containing the following keys:
+        members - sparse matrix (regions x cells), set to 1 for cells within each region
+        weighted - sparse matrix (regions x cells), members multiplied by weights (same as members if no weights are given)
+        cells - data frame, containing the index of each cell in the flattened grid
+        regions - list, containing names of regions (one per row of the operator)
+    '''
+    
+    #Keep regions in the order requested and set cells outside regions to zero
+    mask = mask.sel(region = regionNames).fillna(0)
+    
+    if weights is not None:
+        #Keep only cells shared by the mask and weights
+        mask, weights = xr.align(mask, weights, join = 'inner')
+        weights = weights.fillna(0)
+        #Dimensions in weights but not in the mask (e.g., lev) are placed first
+        extra_dims = [d for d in weights.dims if d not in mask.dims]
+    else:
+        extra_dims = []
+    
+    #Flatten the mask into a regions x cells matrix
+    map_dims = [d for d in mask.dims if d != 'region']
+    mask = mask.transpose('region', *map_dims)
+    members = sp.csr_matrix(mask.values.reshape(len(regionNames), -1) > 0, dtype = np.float64)
+    
+    #Repeat the 2D operator for every value of the extra dimensions (e.g., one block per depth level)
+    cell_coords = {}
+    n_extra = 1
+    for d in extra_dims:
+        cell_coords[d] = weights[d].values
+        n_extra *= weights.sizes[d]
+    if n_extra > 1:
+        members = sp.hstack([members]*n_extra, format = 'csr')
+    
+    #Fold weights into the operator
+    cell_dims = extra_dims+map_dims
+    if weights is not None:
+        w = weights.transpose(*cell_dims).values.ravel()
+        weighted = members.multiply(w[np.newaxis, :]).tocsr()
+        weighted.eliminate_zeros()
+    else:
+        weighted = members
+    
+    #Index of each cell in the flattened grid, used to match data arrays with the operator
+    for d in map_dims:
+        cell_coords[d] = mask[d].values
+    shape = [len(cell_coords[d]) for d in cell_dims]
+    cells = xr.DataArray(np.arange(np.prod(shape)).reshape(shape), dims = cell_dims, 
+                         coords = cell_coords)
+    
+    reg_op = {'members': members, 'weighted': weighted, 'cells': cells, 'regions': list(regionNames)}
+    
+    return reg_op
+
+########
+#Calculates weighted sums, sum of weights and counts for all regions with one matrix product per chunk
+def regionStats(var_df, reg_op, regions = None, moments = False):
+    '''
+    Inputs:
+    var_df - data frame, containing variables of interest
+    reg_op - dictionary, sparse operator created with creatingMask (sparse = True) or regionOperator
+    
+    Optional inputs:
+    regions - list, containing names of regions to be included. If not given, all regions in the operator are used
+    moments - boolean, if True weighted and unweighted variances are also calculated in the same pass
+            
+    Returns:
+    stats - dataset, containing the weighted sum (w_sum), the sum of weights of valid cells (weights) and 
+    the number of valid cells (count) per region. If moments is True, it also includes the unweighted mean (mean),
+    the weighted and unweighted population variances (w_var, var) and the number of valid cells with non-zero 
+    weights (w_count)
+    '''
+    
+    if regions is None:
+        regions = reg_op['regions']
+    rows = [reg_op['regions'].index(reg) for reg in regions]
+    
+    #Dimensions that will be reduced
+    cells = reg_op['cells']
+    cell_dims = list(cells.dims)
+    if not all(d in var_df.dims for d in cell_dims):
+        raise ValueError(f'Data array must include all operator dimensions: {cell_dims}')
+    
+    #Select operator columns for cells included in the data array (e.g., a subset of depth levels)
+    var_df, cells = xr.align(var_df, cells, join = 'inner')
+    idx = cells.transpose(*cell_dims).values.ravel()
+    weighted = reg_op['weighted'][rows][:, idx].tocsr()
+    members = reg_op['members'][rows][:, idx].tocsr()
+    #Cells with non-zero weights, used for the Bessel's correction of weighted variances
+    w_members = (weighted != 0).astype(np.float64)
+    
+    #All cells must be in the same chunk so each time chunk is reduced with one product
+    if var_df.chunks is not None:
+        var_df = var_df.chunk({d: -1 for d in cell_dims})
+    
+    names = ['w_sum', 'weights', 'count']
+    if moments == True:
+        names += ['mean', 'w_var', 'var', 'w_count']
+    
+    def _reduce(x):
+        lead = x.shape[:x.ndim-len(cell_dims)]
+        x = x.reshape(-1, len(idx))
+        valid = ~np.isnan(x)
+        #Shift values by the mean of each timestep before calculating moments to avoid loss of precision
+        if moments == True:
+            shift = np.nanmean(np.where(valid.any(axis = 1, keepdims = True), x, 0), axis = 1, keepdims = True)
+        else:
+            shift = np.zeros((x.shape[0], 1))
+        x = np.where(valid, x-shift, 0)
+        valid = valid.astype(np.float64)
+        #Sums of weights, weighted values and counts for all regions at once
+        sw = (weighted @ valid.T).T
+        swx = (weighted @ x.T).T
+        n = (members @ valid.T).T
+        out = [swx+shift*sw, sw, n]
+        if moments == True:
+            x2 = x**2
+            sx = (members @ x.T).T
+            swx2 = (weighted @ x2.T).T
+            sx2 = (members @ x2.T).T
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                w_var = swx2/sw-(swx/sw)**2
+                var = sx2/n-(sx/n)**2
+                mean = shift+sx/n
+            out += [mean, np.maximum(w_var, 0), np.maximum(var, 0), (w_members @ valid.T).T]
+        return tuple(o.reshape(lead+(len(rows),)) for o in out)
+    
+    out = xr.apply_ufunc(_reduce, var_df, input_core_dims = [cell_dims], 
+                         output_core_dims = [['region']]*len(names), dask = 'parallelized',
+                         output_dtypes = [np.float64]*len(names), 
+                         dask_gufunc_kwargs = {'output_sizes': {'region': len(rows)}})
+    
+    stats = xr.Dataset(dict(zip(names, out)))
+    stats = stats.assign_coords(region = list(regions)).transpose('region', ...)
+    
+    return stats
+
 ########
 #Calculates weighted means by season, by month or per timestep
 def weightedMeans(regions, var_df, mask_df, weights):
@@ -199,12 +626,19 @@ def weightedMeans(regions, var_df, mask_df, weights):
     Inputs:
     regions - list, containing names of regions within mask
     var_df - data frame, containing variables of interest
-    mask_df - data frame, to mask data
-    weights - data frame, containing weights to be applied to mean calculations
+    mask_df - data frame, to mask data. It can also be a sparse operator created with creatingMask (sparse = True)
+    weights - data frame, containing weights to be applied to mean calculations. Ignored if mask_df is a sparse 
+    operator as weights are already included in the operator
             
     Returns:
     mean_calcs - data frame, containing weighted monthly means per sector
     '''
+    #If a sparse operator is given, calculate means for all regions at once
+    if 'cells' in mask_df.keys():
+        stats = regionStats(var_df, mask_df, regions)
+        mean_calcs = stats['w_sum']/stats['weights'].where(stats['weights'] > 0)
+        return mean_calcs
+    
     #Empty lists to save results
     mean_calcs = []
     
@@ -232,96 +666,217 @@ def weightedMeans(regions, var_df, mask_df, weights):
 
 ########
 #This function calculates weighted and unweighted standard deviations
-def std_dev(regions, var_df, mask_df, weights, weighted_means):
+def std_dev(regions, var_df, mask_df, weights, weighted_means = None):
     '''
     Inputs:
     regions - list, containing names of regions within mask
     var_df - data frame, containing variables of interest
-    mask_df - data frame, to mask data
-    weights - data frame, containing weights to be applied to mean calculations
-    weighted_means - data frame, containing weighted means
+    mask_df - data frame, to mask data. It can also be a sparse operator created with creatingMask (sparse = True)
+    weights - data frame, containing weights to be applied to mean calculations. Ignored if mask_df is a sparse 
+    operator as weights are already included in the operator
+    
+    Optional inputs:
+    weighted_means - data frame, containing weighted means. No longer needed as means are calculated together
+    with standard deviations, it is kept so existing calls still work
             
     Returns:
     un_std_calcs - data frame, containing unweighted monthly std dev per sector
-    w_std_calcs - data frame, containing weighted monthly std dev per sector
+    w_std_calcs - data frame, containing weighted monthly std dev per sector. Only cells with data in each timestep 
+    are included in the sum of weights and in the number of cells used for Bessel's correction. Earlier versions 
+    included all cells in the region with a weight, even when data was missing, which underestimated the std dev. 
+    Results differ from outputs calculated with earlier versions wherever data is missing within a region
     '''
     
-    #Empty lists to save results
-    un_std_calcs = []
-    w_std_calcs = []
+    #Build a sparse operator for all regions if masks for individual regions are given
+    if 'cells' not in mask_df.keys():
+        mask = xr.concat([mask_df[reg] for reg in regions], dim = 'region')
+        mask_df = regionOperator(mask, regions, weights = weights)
     
-    #For each region in mask perform calculation
-    for reg in regions:
-        #Apply mask to variable 
-        var_reg = var_df*mask_df[reg]
-        #Apply mask to volume data and replace NAs with zeroes prior to weighting data
-        weight_reg = weights*mask_df[reg]
-        weight_reg = weight_reg.fillna(0)
-        
-        #Calculating unweighted standard deviation
-        if 'lev' in var_df.coords:
-            std_unweighted_var = var_reg.std(('lev', 'latitude', 'longitude'))
-        else:
-            std_unweighted_var = var_reg.std(('latitude', 'longitude'))
-        un_std_calcs.append(std_unweighted_var)
-        
-        #Calculating weighted standard deviation
-        #Calculate Bessel's correction for sample std (i.e., (n-1)/n)
-        bes_cor = ((weight_reg/weight_reg).sum()-1)/(weight_reg/weight_reg).sum()
-        #Divisor
-        divisor =  weight_reg.sum()*bes_cor
-        #Dividend
-        std = []
-        for t in var_reg.time:
-            if 'lev' in var_df.coords:
-                dif = (weight_reg*((var_reg.sel(time = t)-weighted_means.sel(region = reg, time = t))**2)).sum(('lev',                                  'latitude', 'longitude'))
-            else:
-                dif = (weight_reg*((var_reg.sel(time = t)-weighted_means.sel(region = reg, time = t))**2)).sum(('latitude', 'longitude'))
-            var = dif/divisor
-            std.append(np.sqrt(var.values))
-        std = xr.DataArray(std, dims = ['time'], coords = {'time': var_reg.time})
-        std = std.expand_dims({'region': [reg]})
-        w_std_calcs.append(std)
+    #Calculate sums, weights and squared deviations for all regions and timesteps in one pass
+    stats = regionStats(var_df, mask_df, regions, moments = True)
     
-    # Create one netcdf file per calculation and saving result
-    un_std_calcs = xr.concat(un_std_calcs, dim = 'region')
-    w_std_calcs = xr.concat(w_std_calcs, dim = 'region')
+    #Calculating unweighted standard deviation
+    un_std_calcs = np.sqrt(stats['var'])
+    
+    #Calculating weighted standard deviation
+    #Calculate Bessel's correction for sample std (i.e., n/(n-1))
+    bes_cor = stats['w_count']/(stats['w_count']-1)
+    w_std_calcs = np.sqrt(stats['w_var']*bes_cor.where(stats['w_count'] > 1))
     
     return un_std_calcs, w_std_calcs
 
 
 ########
 #This function calculates percentiles
-def perc_calc(regions, var_df, mask_df, percentiles):
+def perc_calc(regions, var_df, mask_df, percentiles, method = 'exact', **kwargs):
     '''
     Inputs:
     regions - list, containing names of regions within mask
     var_df - data frame, containing variables of interest
-    mask_df - data frame, to mask data
+    mask_df - data frame, to mask data. It can also be a sparse operator created with creatingMask (sparse = True), 
+    which must include all spatial dimensions of var_df (e.g., lev)
     percentiles - list, percentiles that need to be calculated
+    method - str, 'exact' (default) calculates percentiles using only the cells within each region. 'histogram'
+    streams through time and depth chunks accumulating fixed-bin histograms per region and timestep, so memory use
+    is bounded by the chunk size
+    
+    Optional inputs (only used if method is 'histogram'):
+    bins - int, number of histogram bins. Default is 1000
+    value_range - list, minimum and maximum values covered by the bins. If not given, it is calculated from the data. 
+    Values outside this range are counted in the first or last bin
+    time_chunk - int, number of timesteps loaded at once. Default is 12
+    lev_chunk - int, number of depth levels loaded at once. Default is 10
             
     Returns:
-    per_calcs - data frame, containing monthly percentiles per sector
+    per_calcs - data frame, containing monthly percentiles per sector. If method is 'histogram', the maximum absolute 
+    error of the percentiles (i.e., the bin width) is stored in the 'max_abs_error' attribute. This is set to infinity 
+    if any values are outside value_range (see perc_hist)
     '''
-    #Empty lists to save results
-    per_calcs = []
+    
+    #Build a sparse operator for all regions if masks for individual regions are given
+    if 'cells' not in mask_df.keys():
+        mask = xr.concat([mask_df[reg] for reg in regions], dim = 'region')
+        #Cells are defined by all spatial dimensions of the data (e.g., lev, latitude and longitude)
+        cell_template = xr.ones_like(var_df.isel(time = 0, drop = True))
+        mask_df = regionOperator(mask, regions, weights = cell_template)
+    
+    #Select operator columns for cells included in the data array
+    rows = [mask_df['regions'].index(reg) for reg in regions]
+    var_df, cells = xr.align(var_df, mask_df['cells'], join = 'inner')
+    cell_dims = list(cells.dims)
+    members = mask_df['members'][rows]
+    
+    if method == 'exact':
+        idx = cells.transpose(*cell_dims).values.ravel()
+        members = members[:, idx].tocsr()
+        #Position of cells within each region in the flattened grid
+        cols = [np.sort(members[i].indices) for i in range(len(rows))]
+        
+        #All cells must be in the same chunk so percentiles are calculated per time chunk
+        if var_df.chunks is not None:
+            var_df = var_df.chunk({d: -1 for d in cell_dims})
+        
+        def _exact(x):
+            lead = x.shape[:x.ndim-len(cell_dims)]
+            x = x.reshape(-1, len(idx))
+            out = np.full((x.shape[0], len(rows), len(percentiles)), np.nan)
+            #Only cells within the region are sorted
+            for i, c in enumerate(cols):
+                if len(c) > 0:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore', category = RuntimeWarning)
+                        out[:, i, :] = np.nanquantile(x[:, c], percentiles, axis = 1).T
+            return out.reshape(lead+(len(rows), len(percentiles)))
+        
+        per_calcs = xr.apply_ufunc(_exact, var_df, input_core_dims = [cell_dims], 
+                                   output_core_dims = [['region', 'quantile']], dask = 'parallelized',
+                                   output_dtypes = [np.float64], 
+                                   dask_gufunc_kwargs = {'output_sizes': {'region': len(rows), 
+                                                                          'quantile': len(percentiles)}})
+        per_calcs = per_calcs.assign_coords(region = list(regions), quantile = list(percentiles))
+        
+    elif method == 'histogram':
+        per_calcs = perc_hist(var_df, cells, members, percentiles, **kwargs)
+        per_calcs = per_calcs.assign_coords(region = list(regions))
+    
+    else:
+        raise ValueError("method must be 'exact' or 'histogram'")
+    
+    per_calcs = per_calcs.transpose('region', 'quantile', ...)
+    
+    return per_calcs
 
-    #For each region in mask perform calculation
-    for reg in regions:
-        #Apply mask to variable 
-        var_reg = var_df*mask_df[reg]
+########
+#This function calculates approximate percentiles from fixed-bin histograms accumulated over time and depth chunks
+def perc_hist(var_df, cells, members, percentiles, bins = 1000, value_range = None, time_chunk = 12, lev_chunk = 10):
+    '''
+    Inputs:
+    var_df - data frame, containing variables of interest. It must include a time dimension
+    cells - data frame, containing the index of each cell in the flattened grid (see regionOperator)
+    members - sparse matrix (regions x cells), set to 1 for cells within each region
+    percentiles - list, percentiles that need to be calculated
+    
+    Optional inputs:
+    bins - int, number of histogram bins. Default is 1000
+    value_range - list, minimum and maximum values covered by the bins. If not given, it is calculated from the data. 
+    Values outside this range are counted in the first or last bin
+    time_chunk - int, number of timesteps loaded at once. Default is 12
+    lev_chunk - int, number of depth levels loaded at once. Default is 10
+            
+    Returns:
+    per_calcs - data frame, containing percentiles per region and timestep. The maximum absolute error is stored in 
+    the 'max_abs_error' attribute. If any values are outside value_range, the error is not bounded, so 'max_abs_error' 
+    is set to infinity and the number of values outside the range is stored in the 'out_of_range' attribute
+    '''
+    
+    cell_dims = list(cells.dims)
+    var_df = var_df.transpose('time', *cell_dims)
+    
+    #Define bin edges
+    if value_range is None:
+        value_range = [float(var_df.min()), float(var_df.max())]
+    width = (value_range[1]-value_range[0])/bins
+    if width <= 0:
+        width = 1
+    
+    #Depth levels are streamed only if present in the data
+    if 'lev' in cell_dims:
+        lev_blocks = [slice(i, i+lev_chunk) for i in range(0, var_df.sizes['lev'], lev_chunk)]
+    else:
+        lev_blocks = [slice(None)]
+    
+    #Rank of each percentile (linear interpolation between the two closest values)
+    q = np.asarray(percentiles)
+    per_calcs = []
+    out_of_range = 0
+    
+    for t0 in range(0, var_df.sizes['time'], time_chunk):
+        t_block = slice(t0, t0+time_chunk)
+        nt = len(var_df.time[t_block])
+        counts = np.zeros((members.shape[0], nt*bins))
         
-        #Calculate percentiles per sector
-        if 'lev' in var_df.coords:
-            perc_var = var_reg.quantile(percentiles, ('lev', 'latitude', 'longitude'))
-        else:
-            perc_var = var_reg.quantile(percentiles, ('latitude', 'longitude'))
-        perc_var = perc_var.expand_dims({'region': [reg]})
-        #Save in empty list before concatenation
-        per_calcs.append(perc_var)
+        #Accumulate histograms one chunk at a time
+        for l_block in lev_blocks:
+            sub = {'lev': l_block} if 'lev' in cell_dims else {}
+            x = var_df.isel(time = t_block, **sub).values.reshape(nt, -1)
+            idx = cells.isel(**sub).transpose(*cell_dims).values.ravel()
+            valid = ~np.isnan(x)
+            t_id, c_id = np.nonzero(valid)
+            out_of_range += int(np.sum((x[valid] < value_range[0]) | (x[valid] > value_range[1])))
+            b_id = np.clip(np.floor((x[valid]-value_range[0])/width), 0, bins-1).astype(np.int64)
+            #One column per timestep and bin, so all timesteps are counted with one product
+            hist = sp.csr_matrix((np.ones(len(c_id)), (c_id, t_id*bins+b_id)), shape = (len(idx), nt*bins))
+            counts += (members[:, idx] @ hist).toarray()
+        
+        counts = counts.reshape(-1, nt, bins)
+        cum = counts.cumsum(axis = -1)
+        n = cum[..., -1]
+        
+        #Estimate order statistics at the centre of their share of the bin, then interpolate between them
+        def _order_stat(j):
+            b = (cum > j[..., np.newaxis]).argmax(axis = -1)
+            c_bin = np.take_along_axis(counts, b[..., np.newaxis], -1)[..., 0]
+            c_before = np.take_along_axis(cum, b[..., np.newaxis], -1)[..., 0]-c_bin
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                return value_range[0]+width*(b+(j-c_before+0.5)/c_bin)
+        
+        out = []
+        for p in q:
+            rank = p*(n-1)
+            j0 = np.floor(rank)
+            j1 = np.minimum(j0+1, n-1)
+            v = _order_stat(j0)+(rank-j0)*(_order_stat(j1)-_order_stat(j0))
+            out.append(np.where(n > 0, v, np.nan))
+        per_calcs.append(np.stack(out, axis = 1))
     
-    #Create one netcdf file per calculation and saving result
-    per_calcs = xr.concat(per_calcs, dim = 'region')
+    per_calcs = xr.DataArray(np.concatenate(per_calcs, axis = -1), dims = ['region', 'quantile', 'time'], 
+                             coords = {'quantile': list(percentiles), 'time': var_df.time})
+    per_calcs.attrs['max_abs_error'] = width
+    #Error cannot be bounded if values were clipped into the first or last bin
+    if out_of_range > 0:
+        warnings.warn(f'{out_of_range} values are outside value_range {value_range}, percentiles may not be accurate')
+        per_calcs.attrs['max_abs_error'] = np.inf
+        per_calcs.attrs['out_of_range'] = out_of_range
     
     return per_calcs
     
@@ -340,11 +895,8 @@ def getFileList(filein, yrs):
     filelist = os.listdir(filein)
  
     #Extract files for baseline years
-    basefiles = []
-    for i in filelist:
-        for j in yrs:
-            if i[10:14] == str(j):
-                basefiles.append(i)
+    yrs = set([str(j) for j in yrs])
+    basefiles = [i for i in filelist if i[10:14] in yrs]
     #Remove variables no longer in use
     del filelist
 
@@ -359,6 +911,84 @@ def getFileList(filein, yrs):
     return adv_list, ret_list, sea_list
 
 
+########
+#Defines how variables are saved in netcdf files, so outputs are compact and compressed
+def setEncoding(data, index = None, packing = 'float32', compression = 'zlib', complevel = 4, chunks = None):
+    '''
+    Inputs:
+    data - data frame or dataset, to be saved
+    index - boolean, if True variables are saved as the smallest integer type that fits their values (e.g., day of 
+    year). Missing values are saved as a fill value. Default is None, which uses integers only for variables with 
+    integer (or boolean) values. Variables read from files packed with scale factor or offset are never saved as 
+    integers without packing
+    packing - str, how continuous variables are saved: 'float32' (default), 'int16' (values are packed using scale 
+    factor and offset) or None (data type is not changed)
+    compression - str, compression used: 'zlib' (default) or any other compression supported by netcdf (e.g., 'zstd')
+    complevel - int, compression level from 1 to 9. Default is 4
+    chunks - dictionary, chunk size for any dimension. By default, time is split in chunks of 16 time steps and the 
+    last two dimensions (map) in chunks of 128 cells, so both time series and maps are read quickly. Any other 
+    dimensions are saved one value per chunk
+    
+    Returns:
+    data - copy of data frame or dataset with encoding included. Data is not copied
+    '''
+    data = data.copy(deep = False)
+    ds = data.to_dataset(name = data.name if data.name is not None else '__xarray_dataarray_variable__') \
+    if isinstance(data, xr.DataArray) else data
+    
+    for v in ds.data_vars:
+        var = ds[v]
+        if not np.issubdtype(var.dtype, np.number) and var.dtype != bool:
+            continue
+        enc = {'zlib': True} if compression == 'zlib' else {'compression': compression}
+        enc.update({'complevel': complevel, 'shuffle': True})
+        
+        #Chunks suited for reading time series and maps
+        if var.ndim > 1 and 0 not in var.shape:
+            sizes = []
+            for i, (d, n) in enumerate(zip(var.dims, var.shape)):
+                if chunks is not None and d in chunks.keys():
+                    size = chunks[d]
+                elif d == 'time':
+                    size = 16
+                elif i >= var.ndim-2:
+                    size = 128
+                else:
+                    size = 1
+                sizes.append(min(size, n))
+            enc['chunksizes'] = tuple(sizes)
+        
+        #Integer variables are saved using the smallest integer type available
+        is_index = index
+        if is_index is None:
+            is_index = np.issubdtype(var.dtype, np.integer) or var.dtype == bool
+        #Packed continuous variables (e.g., int16 with scale factor) are not index variables
+        if 'scale_factor' in var.encoding.keys() or 'add_offset' in var.encoding.keys():
+            is_index = False
+        if is_index or packing == 'int16':
+            #Minimum and maximum are calculated together, so lazy data is only read once
+            vmin, vmax = [float(x) for x in xr.Dataset({'min': var.min(), 'max': var.max()}).compute().values()]
+        if is_index:
+            for dtype in ['int8', 'int16', 'int32', 'int64']:
+                info = np.iinfo(dtype)
+                if np.isnan(vmin) or (vmin > info.min and vmax <= info.max):
+                    break
+            enc.update({'dtype': dtype, '_FillValue': np.iinfo(dtype).min})
+        elif packing == 'float32':
+            enc.update({'dtype': 'float32'})
+        elif packing == 'int16':
+            #Values are packed between -32767 and 32767, -32768 is used for missing values
+            scale = (vmax - vmin)/65534 if vmax > vmin else 1.0
+            enc.update({'dtype': 'int16', 'scale_factor': scale, 'add_offset': (vmax + vmin)/2, 
+                        '_FillValue': np.int16(-32768)})
+        
+        ds[v].encoding = enc
+    
+    if isinstance(data, xr.DataArray):
+        data.encoding = ds[list(ds.data_vars)[0]].encoding
+    
+    return data
+
 ########
 #This function can be used to calculate baseline means or to extract files for any other time period
 def combineData(filepath, filelist, dir_out):
@@ -382,7 +1012,7 @@ def combineData(filepath, filelist, dir_out):
         
     #Create one data array with the data contained in the combined variable
     combined = xr.concat(combData, dim = 'time')
-    combined.to_netcdf(os.path.join(dir_out, (filelist[0][0:15]+filelist[-1][15:19]+'.nc')))
+    setEncoding(combined).to_netcdf(os.path.join(dir_out, (filelist[0][0:15]+filelist[-1][15:19]+'.nc')))
     return combined
     
 
@@ -3,23 +3,45 @@ import argparse
 import cosima_cookbook as cc
 import netCDF4 as nc
 import xarray as xr
+import dask
 import numpy as np
 import pandas as pd
 import copy
 import os
 import re
+import json
+import hashlib
+import shutil
+import time
+import threading
 import rasterio
 import geopandas
 import rasterio.plot
+import rasterio.features
 import rioxarray
 from shapely.geometry import mapping, Polygon
 import calendar
+import warnings
 import statsmodels.api as sm
 import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import scipy.stats as ss
 from glob import glob
 import xesmf as xe
-from pyproj import Transformer, CRS, transform, Proj
+from pyproj import Transformer, CRS
+
+########
+#Grids already loaded in this process (see getGrid) and folder where grids are saved
+GRIDS = {}
+GRID_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ACCESS_grids')
+#Clipping masks already loaded in this process (see getClipMask)
+MASKS = {}
+#Regridders already created in this process (see getRegridder) and folder where regridding weights are saved
+REGRIDDERS = {}
+WEIGHTS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ACCESS_regrid_weights')
+#Coordinate transformers and latitude and longitude grids already calculated in this process (see latlonGrid)
+TRANSFORMERS = {}
+LATLON = {}
 
 ########
 #Defining functions
@@ -27,15 +49,18 @@ from pyproj import Transformer, CRS, transform, Proj
 ########
 #Loads ACCESS-OM2-01 sea ice and ocean data for the Southern Ocean. If ice data is accessed, it corrects the time and coordinate grid to match ocean outputs.
 def getACCESSdata(var, start, end, freq, ses, minlat = -90, maxlat = -45, 
-                  exp = '01deg_jra55v140_iaf_cycle2', ice_data = False):
+                  exp = '01deg_jra55v140_iaf_cycle2', ice_data = False, cache_dir = None, cache_size = 50,
+                  minlon = None, maxlon = None, mindepth = None, maxdepth = None, chunks = None):
     '''
     Defining function that loads data automatically using `cc.querying.getvar()` in a loop. The inputs needed are similar to those for the `cc.querying.getvar()` function, with the addition of inputs to define an area of interest.  
 The `getACCESSdata` will achieve the following:  
 - Access data for the experiment and variable of interest at the frequency requested and within the time frame specified  
 - Apply **time corrections** as midnight (00:00:00) is interpreted differently by the CICE model and the xarray package.
-    - CICE reads *2010-01-01 00:00:00* as the start of 2010-01-01, while xarray interprets it as the start of the following day (2010-01-02). To fix this problem, 12 hours are subtracted from the time dimension (also known as *time coordinate*).  
+    - CICE reads *2010-01-01 00:00:00* as the start of 2010-01-01, while xarray interprets it as the start of the following day (2010-01-02). To fix this problem, 12 hours are subtracted from the time dimension (also known as *time coordinate*). The time frame of interest is selected after this correction.  
 - Latitude and longitude will be corrected in the dataset using the `geolon_t` dataset. The coordinate names are replaced by names that are more intuitive.  
 - Minimum and maximum latitudes and longitudes can be specified in the function to access specific areas of the dataset if required.  The **Southern Ocean** is defined as ocean waters south of 45S.
+- Spatial and depth limits are applied to each file as it is opened, so only the rows, columns and levels requested are read from disk.
+- Optionally, corrected and subset results are stored in a local cache (zarr store) so the same call does not need to query the database or open netcdf files again. Cached results are discarded if any of the source files change.
 
     Inputs:
     var - Short name for the variable of interest
@@ -47,17 +72,81 @@ The `getACCESSdata` will achieve the following:
     maxlat - maximum latitude from which to return data. If not set, defaults to -45 to cover the Southern Ocean.
     exp - Experiment name. Default is 01deg_jra55v140_iaf_cycle2.
     ice_data - Boolean, when True the variable being called is related to sea ice, when False is not. Default is set to False (i.e., it assumes variable is related to the ocean).
+    cache_dir - Folder where cached results are stored. If not set, results are not cached.
+    cache_size - Maximum size of the cache in GB. When exceeded, the least recently used results are removed. Default is 50.
+    minlon - minimum longitude from which to return data, in the original model grid (between -280 and +80). If not set, all longitudes are returned.
+    maxlon - maximum longitude from which to return data, in the original model grid (between -280 and +80). If not set, all longitudes are returned.
+    mindepth - minimum depth from which to return data. Only used for variables with a depth dimension. If not set, data is returned from the surface.
+    maxdepth - maximum depth from which to return data. Only used for variables with a depth dimension. If not set, data is returned to the bottom.
+    chunks - Dictionary with chunk sizes used to open each file. If not set, the chunks of the files on disk are used, with chunk boundaries placed at the edges of the area and depths of interest, so only the requested rows, columns and levels are read.
         
     Output:
     Data array with corrected time and coordinates within the specified time period and spatial bounding box.
     '''
+    #Return cached results if available
+    if cache_dir is not None:
+        key_args = {'exp': exp, 'var': var, 'freq': freq, 'start': str(start), 'end': str(end), 
+                    'minlat': minlat, 'maxlat': maxlat, 'ice_data': ice_data, 'minlon': minlon, 
+                    'maxlon': maxlon, 'mindepth': mindepth, 'maxdepth': maxdepth}
+        cached = readCache(cache_dir, key_args)
+        if cached is not None:
+            return cached
+    
     #Accessing data
-    vararray = cc.querying.getvar(exp, var, ses, frequency = freq, start_time = start, end_time = end)
+    files = getACCESSfiles(var, start, end, freq, ses, exp = exp)
+    if len(files) == 0:
+        if cache_dir is not None:
+            print('Source files could not be listed, cached results will not be checked for changes.')
+        #If files cannot be listed, subsets are applied after loading data
+        vararray = cc.querying.getvar(exp, var, ses, frequency = freq, start_time = start, end_time = end)
     
-    #If data being accessed is an ice related variable, then apply the following steps
     if ice_data == True:
+        #Shape of the sea ice grid is used to check the grid matches the data
+        if len(files) > 0:
+            with xr.open_dataset(files[0]) as ds:
+                shape = (ds.sizes['nj'], ds.sizes['ni'])
+        else:
+            shape = (vararray.sizes['nj'], vararray.sizes['ni'])
         #Accessing corrected coordinate data to update geographical coordinates in the array of interest
-        geolon_t = cc.querying.getvar(exp, 'geolon_t', ses, n = -1)
+        #Grid is only loaded once per experiment
+        geolon_t = getGrid(exp, ses, shape = shape)
+        #CICE outputs use index based dimensions (ni, nj), so limits are converted to index positions
+        ice_lims = {'nj': geolon_t.indexes['yt_ocean'].slice_indexer(minlat, maxlat),
+                    'ni': geolon_t.indexes['xt_ocean'].slice_indexer(minlon, maxlon)}
+        geolon_t = geolon_t.isel(yt_ocean = ice_lims['nj'], xt_ocean = ice_lims['ni'])
+    
+    #Index positions of area and depths of interest in each dimension
+    def _limits(da):
+        if ice_data == True:
+            return {d: ice_lims[d] for d in ice_lims.keys() if d in da.dims}
+        lims = {}
+        for d in da.dims:
+            if d.startswith('y'):
+                lims[d] = da.indexes[d].slice_indexer(minlat, maxlat)
+            elif d.startswith('x'):
+                lims[d] = da.indexes[d].slice_indexer(minlon, maxlon)
+            elif d in ['st_ocean', 'sw_ocean']:
+                lims[d] = da.indexes[d].slice_indexer(mindepth, maxdepth)
+        return lims
+    
+    #Subset each file as it is opened
+    def _subset(ds):
+        da = ds[var]
+        return da.isel(**_limits(da)).to_dataset()
+    
+    if len(files) > 0:
+        #Chunks are aligned with the subset, so data outside the area and depths of interest is not read
+        if chunks is None:
+            with xr.open_dataset(files[0]) as ds:
+                chunks = subsetChunks(ds[var], _limits(ds[var]))
+        #Only files overlapping the time frame of interest are opened
+        vararray = xr.open_mfdataset(files, preprocess = _subset, combine = 'by_coords', parallel = True, 
+                                     chunks = chunks)[var]
+    else:
+        vararray = _subset(vararray.to_dataset(name = var))[var]
+    
+    #If data being accessed is an ice related variable, then apply the following steps
+    if ice_data == True:
         #Apply time correction so data appears in the middle (12:00) of the day rather than at the beginning of the day (00:00)
         vararray['time'] = vararray.time.to_pandas() - dt.timedelta(hours = 12)
         #Change coordinates so they match ocean dimensions 
@@ -69,10 +158,211 @@ The `getACCESSdata` will achieve the following:
         vararray = vararray.drop(('TLON', 'TLAT', 'ULON', 'ULAT'))
         #Drop attribute that is not needed
         del vararray.attrs['time_bounds']
+    #Selecting time frame of interest after time corrections, so the last day of ice data is not removed
+    vararray = vararray.sel(time = slice(start, end))
     #Subsetting data to area of interest
     vararray = vararray.sel(yt_ocean = slice(minlat, maxlat))
+    
+    #Saving results to cache
+    if cache_dir is not None:
+        vararray = writeCache(cache_dir, key_args, vararray, files, cache_size = cache_size)
     return vararray
 
+########
+#Gets the list of netcdf files that cc.querying.getvar() opens for a variable
+def getACCESSfiles(var, start, end, freq, ses, exp = '01deg_jra55v140_iaf_cycle2'):
+    '''
+    Inputs:
+    var - Short name for the variable of interest
+    start - Time from when data has to be returned
+    end - Time until when data has to be returned
+    freq - Time frequency of the data
+    ses - Cookbook session
+    exp - Experiment name. Default is 01deg_jra55v140_iaf_cycle2.
+        
+    Output:
+    List of file paths. Empty if the cookbook version used does not allow files to be listed.
+    '''
+    #Files are listed with a private cookbook function, so any errors are treated as files not being available
+    try:
+        ncfiles = cc.querying._ncfiles_for_variable(exp, var, ses, start_time = start, end_time = end, 
+                                                    frequency = freq)
+        return sorted(set(str(f.NCFile.ncfile_path) for f in ncfiles))
+    except Exception:
+        return []
+
+########
+#Calculates chunk sizes with boundaries at the edges of a subset, so chunks are either fully inside or outside the subset
+def subsetChunks(da, lims):
+    '''
+    Inputs:
+    da - Data array opened from a netcdf file (without dask), so the chunks of the file on disk are available
+    lims - Dictionary with slices of index positions to be selected along each dimension
+        
+    Output:
+    Dictionary with chunk sizes for each dimension in lims. Within the subset, chunk boundaries match the chunks of 
+    the file on disk.
+    '''
+    disk = dict(zip(da.dims, da.encoding.get('chunksizes') or da.shape))
+    chunks = {}
+    for d, lim in lims.items():
+        n = da.sizes[d]
+        i0, i1, step = lim.indices(n)
+        #Only contiguous subsets can be aligned with chunks
+        if step != 1 or i1 <= i0:
+            continue
+        edges = [0, i0, i1, n] + list(range((i0//disk[d]+1)*disk[d], i1, disk[d]))
+        chunks[d] = tuple(np.diff(sorted(set(edges))).tolist())
+    
+    return chunks
+
+########
+#Reads results from the local cache if they exist and source files have not changed
+def readCache(cache_dir, key_args):
+    '''
+    Inputs:
+    cache_dir - Folder where cached results are stored
+    key_args - Dictionary with the arguments used to create the cached results
+        
+    Output:
+    Data array loaded from the cache (zarr store). None if results are not cached or source files changed.
+    '''
+    key = hashlib.sha1(json.dumps(key_args, sort_keys = True).encode()).hexdigest()
+    meta_path = os.path.join(cache_dir, f'{key}.json')
+    store = os.path.join(cache_dir, f'{key}.zarr')
+    if not (os.path.isfile(meta_path) and os.path.isdir(store)):
+        return None
+    
+    with open(meta_path) as f:
+        meta = json.load(f)
+    
+    #Discard cached results if any of the source files were modified or removed
+    for fn, mtime in meta['files'].items():
+        if not os.path.isfile(fn) or os.path.getmtime(fn) != mtime:
+            shutil.rmtree(store, ignore_errors = True)
+            os.remove(meta_path)
+            return None
+    
+    #Update last time results were used
+    meta['last_access'] = time.time()
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    
+    return xr.open_zarr(store)[meta['name']]
+
+########
+#Saves results to the local cache and removes least recently used results if the cache is too large
+def writeCache(cache_dir, key_args, array, files, cache_size = 50):
+    '''
+    Inputs:
+    cache_dir - Folder where cached results are stored
+    key_args - Dictionary with the arguments used to create the results
+    array - Data array to be cached
+    files - List of source file paths. Their modification times are used to check cached results are up to date
+    cache_size - Maximum size of the cache in GB. Default is 50.
+        
+    Output:
+    Data array loaded from the cache (zarr store).
+    '''
+    os.makedirs(cache_dir, exist_ok = True)
+    key = hashlib.sha1(json.dumps(key_args, sort_keys = True).encode()).hexdigest()
+    meta_path = os.path.join(cache_dir, f'{key}.json')
+    store = os.path.join(cache_dir, f'{key}.zarr')
+    
+    #Zarr stores need regular chunks and no netcdf encoding
+    ds = array.to_dataset(name = array.name).chunk('auto')
+    for v in ds.variables:
+        ds[v].encoding = {}
+    
+    #Write to a temporary folder first so interrupted writes are not used
+    shutil.rmtree(store + '.tmp', ignore_errors = True)
+    ds.to_zarr(store + '.tmp', mode = 'w')
+    shutil.rmtree(store, ignore_errors = True)
+    os.replace(store + '.tmp', store)
+    
+    size = sum(os.path.getsize(os.path.join(root, fn)) for root, dirs, fns in os.walk(store) for fn in fns)
+    meta = {'args': key_args, 'name': array.name, 'size': size, 'last_access': time.time(),
+            'files': {fn: os.path.getmtime(fn) for fn in files}}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    
+    #Remove least recently used results until cache is within size limit
+    entries = []
+    for fn in glob(os.path.join(cache_dir, '*.json')):
+        with open(fn) as f:
+            entries.append((json.load(f), fn))
+    entries = sorted(entries, key = lambda e: e[0]['last_access'])
+    total = sum(e[0]['size'] for e in entries)
+    for m, fn in entries:
+        if total <= cache_size*1e9 or fn == meta_path:
+            break
+        shutil.rmtree(fn.replace('.json', '.zarr'), ignore_errors = True)
+        os.remove(fn)
+        total -= m['size']
+    
+    return xr.open_zarr(store)[array.name]
+
+########
+#Loads grid information for an experiment. Grids are loaded once per process and saved to a local file
+def getGrid(exp, ses, grid_dir = GRID_DIR, shape = None):
+    '''
+    Inputs:
+    exp - Experiment name
+    ses - Cookbook session. Only used if the grid has not been saved locally before
+    grid_dir - Folder where grids are saved. Default is ~/.cache/ACCESS_grids
+    shape - Optional. Number of rows and columns (yt_ocean, xt_ocean) of the data the grid will be used with. If the 
+    grid loaded in this process or saved locally has a different shape, it is loaded again from the database.
+    
+    Output:
+    Dataset containing 1D coordinates (xt_ocean, yt_ocean) and 2D longitudes (geolon_t).
+    '''
+    #Checks the grid has the same shape as the data
+    def _matches(grid):
+        return shape is None or (grid.sizes['yt_ocean'], grid.sizes['xt_ocean']) == tuple(shape)
+    
+    #Grids already loaded in this process
+    if exp in GRIDS and _matches(GRIDS[exp]):
+        return GRIDS[exp]
+    
+    fn = os.path.join(grid_dir, f'{exp}_grid.nc')
+    grid = xr.load_dataset(fn) if os.path.isfile(fn) else None
+    if grid is not None and not _matches(grid):
+        print(f'Grid saved in {fn} does not match the shape of the data, it will be loaded from the database.')
+        grid = None
+    
+    if grid is None:
+        #Accessing grid from the database
+        grid = cc.querying.getvar(exp, 'geolon_t', ses, n = -1).reset_coords(drop = True).to_dataset().load()
+        if not _matches(grid):
+            raise ValueError(f'Grid for {exp} does not match the shape of the data: {tuple(shape)}')
+        
+        #Saving grid so it does not need to be accessed from the database again
+        os.makedirs(grid_dir, exist_ok = True)
+        for v in grid.variables:
+            grid[v].encoding = {}
+        setEncoding(grid, packing = None).to_netcdf(fn + '.tmp')
+        os.replace(fn + '.tmp', fn)
+    
+    GRIDS[exp] = grid
+    return grid
+
+########
+#Correcting longitude values so they are between -180 and +180 degrees
+def corrLonValues(lon):
+    '''
+    Inputs:
+    lon - numpy array containing longitude values of the ACCESS-OM2 grid (between -280 and +80). It can be a subset 
+    of the grid.
+    
+    Output:
+    Numpy array with corrected longitude values.
+    '''
+    ##Now we need to correct any values smaller than -180 and replace them with values between +80 and +180. Note that the smallest longitude value (-279.95) should be +80.05.
+    #While -180.05 should have a correct value of +179.95.
+    corr_lon = np.where(lon < -180, lon + 360, lon)
+    
+    return corr_lon
+
 ########
 #Correcting longitude values in a data array so they are between -180 and +180 degrees
 def corrlong(array):
@@ -84,32 +374,63 @@ def corrlong(array):
     Data array with corrected longitude values.
     '''
     
-    #Making a deep copy of original longitude values in the array being corrected
-    corr_lon = copy.deepcopy(array.xt_ocean.values)
+    #Longitude values must be sorted from smallest to largest prior to plotting
+    array = recentreLon(array, 'xt_ocean', corrLonValues(array.xt_ocean.values))
     
-    ##Now we need to correct any values smaller than -180 and replace them with values between +80 and +180. Note that the smallest longitude value (-279.95) should be +80.05.
-    #While -180.05 should have a correct value of +179.95.
-    corr_lon[np.where(corr_lon < -180)] = sorted(-corr_lon[np.where((corr_lon >= -180) & (corr_lon <= -80))])
+    return array
+
+########
+#Sorts longitudes from smallest to largest using a circular shift, so data is not reordered element by element
+def recentreLon(array, dim, lon):
+    '''
+    Inputs:
+    array - Data array or dataset to be shifted.
+    dim - Name of the longitude dimension.
+    lon - Numpy array with corrected longitude values (between -180 and +180) in the original order.
     
-    #Assign corrected longitude values to the data array being corrected
-    array.coords['xt_ocean'] = corr_lon
+    Output:
+    Data array with longitudes sorted from smallest to largest. If the array is dask backed, no data is copied until it is computed. Original coordinates are not modified.
+    '''
+    #Position of the smallest longitude, which becomes the first value
+    shift = int(np.argmin(lon))
+    new_lon = np.concatenate([lon[shift:], lon[:shift]])
     
-    #Longitude values must be sorted from smallest to largest prior to plotting
-    array = array.sortby(array.xt_ocean)
+    #If corrected longitudes are not a circular shift of sorted values, sort them instead
+    if np.any(np.diff(new_lon) <= 0):
+        order = np.argsort(lon, kind = 'stable')
+        return array.isel({dim: order}).assign_coords({dim: lon[order]})
+    
+    #Join the two contiguous parts of the array in the new order
+    if shift > 0:
+        kwargs = {'coords': 'minimal', 'compat': 'override'}
+        if isinstance(array, xr.Dataset):
+            kwargs['data_vars'] = 'minimal'
+        array = xr.concat([array.isel({dim: slice(shift, None)}), array.isel({dim: slice(0, shift)})], 
+                          dim = dim, **kwargs)
+    array = array.assign_coords({dim: new_lon})
     
     return array
 
 ########
 #This function assigns the same coordinate reference system (CRS) to the data array being clipped as the clipping shapefile and then clips the data array
-def clipDataArray(array, shp):
+def clipDataArray(array, shp, mask_dir = None, all_touched = False):
     '''
     Inputs:
     array - Data array to be clipped.
     shp - Shapefile to be used for clipping.
+    mask_dir - Optional. Folder where rasterised shapefiles are saved. If provided, the shapefile is rasterised only 
+    once per grid and the mask is reused in later calls.
+    all_touched - If True, all pixels touched by the polygons are kept. Default is False.
     
     Output:
     Clipped data array.
     '''
+    
+    #Clipping using a saved mask
+    if mask_dir is not None:
+        mask, y_slice, x_slice = getClipMask(array, shp, mask_dir, all_touched)
+        clipped = array.isel(yt_ocean = y_slice, xt_ocean = x_slice).where(mask)
+        return clipped.rio.write_crs(shp.crs)
         
     #Set the spatial dimensions of the xarray being clipped
     array.rio.set_spatial_dims(x_dim = 'xt_ocean', y_dim = 'yt_ocean', inplace = True) #inplace = True updates the array instead of creating a copy
@@ -117,10 +438,69 @@ def clipDataArray(array, shp):
     array.rio.write_crs(shp.crs, inplace = True) #inplace = True updates the array instead of creating a copy
     
     #Clipping maintains only those pixels whose center is within the polygon boundaries and drops any data not meeting this requirement.
-    clipped = array.rio.clip(shp.geometry, shp.crs, drop = True, invert = False, all_touched = False)
+    clipped = array.rio.clip(shp.geometry, shp.crs, drop = True, invert = False, all_touched = all_touched)
     
     return clipped
 
+########
+#Rasterises a shapefile onto the grid of a data array and saves the mask, so it is calculated only once
+def getClipMask(array, shp, mask_dir, all_touched = False):
+    '''
+    Inputs:
+    array - Data array with the grid (xt_ocean and yt_ocean) on which the shapefile will be rasterised.
+    shp - Shapefile to be rasterised.
+    mask_dir - Folder where rasterised shapefiles are saved.
+    all_touched - If True, all pixels touched by the polygons are included in the mask. Default is False.
+    
+    Output:
+    Boolean data array with mask for the bounding box of the shapefile, and slices of yt_ocean and xt_ocean 
+    indices covered by the bounding box.
+    '''
+    #Masks are identified by grid, geometries, CRS and rasterisation option
+    key = hashlib.sha1()
+    for v in [array.yt_ocean.values, array.xt_ocean.values]:
+        key.update(np.ascontiguousarray(v, dtype = 'float64').tobytes())
+    for g in shp.geometry:
+        key.update(g.wkb)
+    key.update(f'{shp.crs}{all_touched}'.encode())
+    key = key.hexdigest()
+    
+    if key not in MASKS.keys():
+        mask_path = os.path.join(mask_dir, f'{key}.nc')
+        if os.path.isfile(mask_path):
+            mask = xr.open_dataarray(mask_path).load()
+        else:
+            #Rasterising shapefile using the same grid transform used by rio.clip
+            ny, nx = array.sizes['yt_ocean'], array.sizes['xt_ocean']
+            template = xr.DataArray(np.zeros((ny, nx), dtype = 'int8'), dims = ('yt_ocean', 'xt_ocean'),
+                                    coords = {'yt_ocean': array.yt_ocean.values, 'xt_ocean': array.xt_ocean.values})
+            template = template.rio.set_spatial_dims(x_dim = 'xt_ocean', y_dim = 'yt_ocean')
+            mask = rasterio.features.geometry_mask(shp.geometry, out_shape = (ny, nx), 
+                                                   transform = template.rio.transform(recalc = True),
+                                                   invert = True, all_touched = all_touched)
+            rows = np.where(mask.any(axis = 1))[0]
+            cols = np.where(mask.any(axis = 0))[0]
+            if len(rows) == 0:
+                raise ValueError('No data found in bounds of shapefile')
+            
+            #Keeping only the bounding box of the shapefile
+            mask = template[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1].copy(data = mask[rows[0]:rows[-1]+1, 
+                                                                                     cols[0]:cols[-1]+1])
+            mask.name = 'mask'
+            mask.attrs = {'y_start': int(rows[0]), 'y_stop': int(rows[-1]+1), 
+                          'x_start': int(cols[0]), 'x_stop': int(cols[-1]+1)}
+            os.makedirs(mask_dir, exist_ok = True)
+            setEncoding(mask.astype('int8')).to_netcdf(mask_path + '.tmp')
+            os.replace(mask_path + '.tmp', mask_path)
+        MASKS[key] = mask
+    
+    mask = MASKS[key]
+    y_slice = slice(mask.attrs['y_start'], mask.attrs['y_stop'])
+    x_slice = slice(mask.attrs['x_start'], mask.attrs['x_stop'])
+    mask = xr.DataArray(mask.values.astype(bool), dims = ('yt_ocean', 'xt_ocean'))
+    
+    return mask, y_slice, x_slice
+
 ########
 #Calculates weighted means by season, by month or per timestep
 def weightedMeans(array, weights, meanby = 'timestep'):
@@ -131,19 +511,70 @@ def weightedMeans(array, weights, meanby = 'timestep'):
     meanby - Define how means will be calculate: timestep, month or season. Default set to 'timestep'
     
     Output:
-    Data array containing weighted means
+    Data array containing weighted means. Weights are normalised at each timestep using only cells with valid data
     '''
       
-    #Calculate weights
-    weights = weights/weights.sum()
+    #Calculate weighted mean over space for each timestep. Weights of cells with missing values are excluded.
+    weighted_mean = array.weighted(weights.fillna(0)).mean(('xt_ocean', 'yt_ocean'))
         
-    #Apply weights to variable - Calculate weighted mean over timestep and then calculate the mean by season
+    #Calculate the mean by season or month
     if meanby == 'season':
-        weighted_mean = (array*weights).groupby('time').sum(('xt_ocean', 'yt_ocean')).groupby('time.season').mean()
+        weighted_mean = weighted_mean.groupby('time.season').mean()
     elif meanby == 'month':
-        weighted_mean = (array*weights).groupby('time').sum(('xt_ocean', 'yt_ocean')).groupby('time.month').mean()
-    elif meanby == 'timestep':
-        weighted_mean = (array*weights).groupby('time').sum(('xt_ocean', 'yt_ocean'))
+        weighted_mean = weighted_mean.groupby('time.month').mean()
+        
+    return weighted_mean
+
+########
+#Calculates weighted means by season or by month for every year included in a data array
+def weightedMeansYearly(array, weights, by = 'season', path_out = None):
+    '''
+    Inputs:
+    array - Data array containing variable from which means will be calculated. It can include multiple years.
+    weights - Data array containing weights
+    by - Define how means will be calculate: season or month. Default set to 'season'
+    path_out - Optional. File path where results will be saved as a single netcdf file.
+    
+    Output:
+    Data array containing weighted means with a year and a season (or month) dimension. December values are included 
+    in the summer (DJF) of the following year. Seasons with data for less than three months (e.g., at the start or end 
+    of the array) are set to NaN.
+    '''
+    if by not in ['season', 'month']:
+        raise ValueError("by must be 'season' or 'month'")
+    
+    #Calculate weighted means per timestep
+    weighted_mean = weightedMeans(array, weights, meanby = 'timestep')
+    
+    #Identifying the year and season (or month) of each timestep
+    years = weighted_mean.indexes['time'].year.values
+    if by == 'season':
+        labels = weighted_mean['time.season'].values
+        #December is assigned to the DJF season of the following year
+        years = np.where(weighted_mean.indexes['time'].month.values == 12, years+1, years)
+    elif by == 'month':
+        labels = weighted_mean['time.month'].values
+    
+    #Calculate means for all years and seasons (or months) in a single grouped reduction
+    label_values, label_codes = np.unique(labels, return_inverse = True)
+    year_values, year_codes = np.unique(years, return_inverse = True)
+    codes = xr.DataArray(year_codes*len(label_values) + label_codes, dims = 'time', name = 'group')
+    weighted_mean = weighted_mean.groupby(codes).mean()
+    group = weighted_mean['group'].values
+    
+    #Seasons missing any months are set to NaN, so they are not mistaken for full seasonal means
+    if by == 'season':
+        months = np.unique(np.stack([codes.values, array.indexes['time'].month.values]), axis = 1)
+        n_months = np.bincount(months[0], minlength = group.max()+1)
+        weighted_mean = weighted_mean.where(xr.DataArray(n_months[group] == 3, dims = 'group'))
+    
+    #Reshape results so year and season (or month) are separate dimensions
+    weighted_mean = weighted_mean.assign_coords(year = ('group', year_values[group//len(label_values)]), 
+                                                **{by: ('group', label_values[group%len(label_values)])})
+    weighted_mean = weighted_mean.set_index(group = ['year', by]).unstack('group')
+    
+    if path_out is not None:
+        setEncoding(weighted_mean).to_netcdf(path_out)
         
     return weighted_mean
 
@@ -234,7 +665,8 @@ def getFileList(filepath, yrs):
     filelist = sorted(glob(os.path.join(filepath, '*.nc')))
  
     #Extract files for baseline years
-    base = [f for f, y in zip(filelist*len(yrs), np.repeat(yrs, len(filelist))) if str(y) in f]
+    yrs = set([str(y) for y in yrs])
+    base = [f for f in filelist if yrs.intersection(re.findall('(?=([0-9]{4}))', os.path.basename(f)))]
 
     #Separate files based on whether they contain information about sea ice advance, retreat or season. Order them alphabetically.
     adv_list = sorted([f for f in np.unique(base) if 'adv' in f.lower()])
@@ -245,6 +677,84 @@ def getFileList(filepath, yrs):
     return adv_list, ret_list, dur_list
 
 
+########
+#Defines how variables are saved in netcdf files, so outputs are compact and compressed
+def setEncoding(data, index = None, packing = 'float32', compression = 'zlib', complevel = 4, chunks = None):
+    '''
+    Inputs:
+    data - Data array or dataset to be saved.
+    index - If True, variables are saved as the smallest integer type that fits their values (e.g., day of year, 
+    number of days). Missing values are saved as a fill value. Default is None, which uses integers only for variables 
+    with integer (or boolean) values. Variables read from files packed with scale factor or offset are never saved as 
+    integers without packing.
+    packing - How continuous variables are saved: 'float32' (default), 'int16' (values are packed using scale factor 
+    and offset) or None (data type is not changed).
+    compression - Compression used: 'zlib' (default) or any other compression supported by netcdf (e.g., 'zstd').
+    complevel - Compression level from 1 to 9. Default is 4.
+    chunks - Optional. Dictionary with chunk size for any dimension. By default, time is split in chunks of 16 time 
+    steps and the last two dimensions (map) in chunks of 128 cells, so both time series and maps are read quickly. 
+    Any other dimensions are saved one value per chunk.
+    
+    Output:
+    Copy of data array or dataset with encoding included. Data is not copied.
+    '''
+    data = data.copy(deep = False)
+    ds = data.to_dataset(name = data.name if data.name is not None else '__xarray_dataarray_variable__') \
+    if isinstance(data, xr.DataArray) else data
+    
+    for v in ds.data_vars:
+        var = ds[v]
+        if not np.issubdtype(var.dtype, np.number) and var.dtype != bool:
+            continue
+        enc = {'zlib': True} if compression == 'zlib' else {'compression': compression}
+        enc.update({'complevel': complevel, 'shuffle': True})
+        
+        #Chunks suited for reading time series and maps
+        if var.ndim > 1 and 0 not in var.shape:
+            sizes = []
+            for i, (d, n) in enumerate(zip(var.dims, var.shape)):
+                if chunks is not None and d in chunks.keys():
+                    size = chunks[d]
+                elif d == 'time':
+                    size = 16
+                elif i >= var.ndim-2:
+                    size = 128
+                else:
+                    size = 1
+                sizes.append(min(size, n))
+            enc['chunksizes'] = tuple(sizes)
+        
+        #Integer variables are saved using the smallest integer type available
+        is_index = index
+        if is_index is None:
+            is_index = np.issubdtype(var.dtype, np.integer) or var.dtype == bool
+        #Packed continuous variables (e.g., int16 with scale factor) are not index variables
+        if 'scale_factor' in var.encoding.keys() or 'add_offset' in var.encoding.keys():
+            is_index = False
+        if is_index or packing == 'int16':
+            #Minimum and maximum are calculated together, so lazy data is only read once
+            vmin, vmax = [float(x) for x in xr.Dataset({'min': var.min(), 'max': var.max()}).compute().values()]
+        if is_index:
+            for dtype in ['int8', 'int16', 'int32', 'int64']:
+                info = np.iinfo(dtype)
+                if np.isnan(vmin) or (vmin > info.min and vmax <= info.max):
+                    break
+            enc.update({'dtype': dtype, '_FillValue': np.iinfo(dtype).min})
+        elif packing == 'float32':
+            enc.update({'dtype': 'float32'})
+        elif packing == 'int16':
+            #Values are packed between -32767 and 32767, -32768 is used for missing values
+            scale = (vmax - vmin)/65534 if vmax > vmin else 1.0
+            enc.update({'dtype': 'int16', 'scale_factor': scale, 'add_offset': (vmax + vmin)/2, 
+                        '_FillValue': np.int16(-32768)})
+        
+        ds[v].encoding = enc
+    
+    if isinstance(data, xr.DataArray):
+        data.encoding = ds[list(ds.data_vars)[0]].encoding
+    
+    return data
+
 ########
 #This function can be used to calculate baseline means or to extract files for any other time period
 def combineData(filelist, **kwargs):
@@ -268,7 +778,7 @@ def combineData(filelist, **kwargs):
         #Get minimum and maximum years to name file 
         minY = combData.time.dt.year.values.min()
         maxY = combData.time.dt.year.values.max()
-        combData.to_netcdf(os.path.join(dir_out, f'{minY}-{maxY}.nc'))
+        setEncoding(combData).to_netcdf(os.path.join(kwargs.get('dir_out'), f'{minY}-{maxY}.nc'))
 
     return combData
     
@@ -316,16 +826,15 @@ def linearTrends(y, x, rsquared = False):
     #To check extra information available in the model use
         #dir(model.fit())
         
+    #Fit model only once. For many series at once use linTrends instead
+    model = sm.OLS(y, x).fit()
+    coef = model.params[1]
+    sig = model.pvalues[1]
+    
     if rsquared == True:
-        model = sm.OLS(y, x)
-        coef = model.fit().params[1]
-        sig = model.fit().pvalues[1]
-        rsq_adj = model.fit().rsquared_adj
+        rsq_adj = model.rsquared_adj
         return coef, sig, rsq_adj
     else:
-        model = sm.OLS(y, x)
-        coef = model.fit().params[1]
-        sig = model.fit().pvalues[1]
         return coef, sig
 
     
@@ -354,77 +863,267 @@ def lm_lats(arr, lats):
     Dataset containing the slope, intercept, p and r squared values, std error and predictions
     for the latitudes of interest
     '''
-    #Create empty list to store results of linear regression
-    slope = []; intercept = []; r_val = []; p_val = []; stderr = []; pred = []
-    #Extract values for each value of interest
-    for lat in lats:
-        sub_lat = arr.sel(yt_ocean = lat, method = 'nearest').dropna('time')
-        #Calculate linear regression
-        try:
-            r_lm = ss.linregress(sub_lat.time.dt.year, sub_lat.values)
-        #If a particular latitude only has NA values, create an exception
-        #so NA values will be returned for all linear regression results
-        except:
-            sub_lat = arr.sel(yt_ocean = lat, method = 'nearest')
-            r_lm = ss.linregress(sub_lat.time.dt.year, sub_lat.values)
-        #Add results to empty lists
-        slope.append(r_lm.slope)
-        intercept.append(r_lm.intercept)
-        r_val.append(r_lm.rvalue)
-        p_val.append(r_lm.pvalue)
-        stderr.append(r_lm.stderr)
-        pred.append(r_lm.intercept+(r_lm.slope*sub_lat.time.dt.year))
-    
-    #Create a data array with predictions 
-    pred = xr.concat(pred, dim = 'yt_ocean')
-    #and the rest of variables
-    slope = xr.DataArray(data = slope, name = 'slope', dims = ['yt_ocean'], 
-                 coords = dict(yt_ocean = arr.yt_ocean.values))
-    intercept = xr.DataArray(data = intercept, name = 'intercept', dims = ['yt_ocean'], 
-                 coords = dict(yt_ocean = arr.yt_ocean.values))
-    p_val = xr.DataArray(data = p_val, name = 'p_val', dims = ['yt_ocean'], 
-                 coords = dict(yt_ocean = arr.yt_ocean.values))
-    r_val = xr.DataArray(data = r_val, name = 'r_val', dims = ['yt_ocean'], 
-                 coords = dict(yt_ocean = arr.yt_ocean.values))
-    stderr = xr.DataArray(data = stderr, name = 'stderr', dims = ['yt_ocean'], 
-                 coords = dict(yt_ocean = arr.yt_ocean.values))
+    #Extract values for each latitude of interest and calculate all linear regressions at once
+    ds = linTrends(arr.sel(yt_ocean = lats, method = 'nearest'), dim = 'time')
+    ds = ds.drop_vars('model_data')
     
     #Change names prior to creating final dataset
-    pred.name = 'predictions'
     arr.name = 'model_data'
     
     #Merge everything into one dataset
-    ds = xr.merge([arr, pred, slope, intercept, r_val, p_val, stderr])
+    ds = xr.merge([arr, ds])
     
     return ds    
     
+########
+#Calculates linear trends for every series in a data array at once using closed form ordinary least squares
+def linTrends(arr, dim = 'time', x = None):
+    '''
+    Inputs:
+    arr - data array containing the dependent variable. A linear regression is calculated along dim for every 
+    combination of the remaining dimensions (e.g., for every grid cell). Works on numpy and dask backed arrays
+    dim - dimension along which linear regressions are calculated. Default is 'time'
+    x - independent variable. It can be a list, numpy array or data array with the same length as dim. If not given, 
+    years are used if dim contains dates, otherwise the values of dim are used
+        
+    Output:
+    Dataset containing the data used (model_data), predictions, slope, intercept, r value (r_val), p value (p_val) 
+    and std error of the slope (stderr). NA values are ignored in each series, series with less than three values 
+    return NA
+    '''
+    
+    #Define independent variable
+    x = trendX(arr, dim, x)
+    
+    #Only values that are not NA are used in each series
+    valid = arr.notnull()
+    xv = x.where(valid)
+    n = valid.sum(dim)
+    
+    #Sums of squares and cross products around the mean of each series
+    dx = xv-xv.sum(dim)/n
+    dy = arr-arr.sum(dim)/n
+    sxx = (dx**2).sum(dim)
+    syy = (dy**2).sum(dim)
+    sxy = (dx*dy).sum(dim)
+    df = (n-2).where(n > 2)
+    
+    #Regression coefficients
+    slope = sxy/sxx
+    intercept = (arr.sum(dim)-slope*xv.sum(dim))/n
+    r_val = (sxy/np.sqrt(sxx*syy)).clip(-1, 1)
+    #Two sided p value based on the t distribution
+    t = r_val*np.sqrt(df/((1-r_val)*(1+r_val)))
+    p_val = xr.apply_ufunc(ss.t.sf, abs(t), df, dask = 'parallelized', output_dtypes = [np.float64])*2
+    stderr = np.sqrt((1-r_val**2)*syy/sxx/df)
+    
+    #Predictions only where data is available
+    pred = (intercept+slope*x).where(valid).transpose(..., dim)
+    
+    #Change names prior to creating final dataset
+    ds = xr.Dataset({'model_data': arr, 'predictions': pred, 'slope': slope.where(df > 0), 
+                     'intercept': intercept.where(df > 0), 'r_val': r_val.where(df > 0), 
+                     'p_val': p_val, 'stderr': stderr})
+    
+    return ds
+
+########
+#Defines the independent variable used in trend calculations
+def trendX(arr, dim = 'time', x = None):
+    '''
+    Inputs:
+    arr - data array containing the dependent variable
+    dim - dimension along which trends are calculated. Default is 'time'
+    x - independent variable. It can be a list, numpy array or data array with the same length as dim. If not given, 
+    years are used if dim contains dates, otherwise the values of dim are used
+        
+    Output:
+    Data array with the independent variable as floats along dim
+    '''
+    if x is None:
+        try:
+            x = arr[dim].dt.year
+        except (AttributeError, TypeError):
+            x = arr[dim]
+    elif not isinstance(x, xr.DataArray):
+        x = xr.DataArray(np.asarray(x), dims = [dim], coords = {dim: arr[dim]})
+    return x.astype(np.float64)
+
+########
+#Calculates Sen's slope and Mann-Kendall trend test for every series in a data array
+def senTrends(arr, dim = 'time', x = None, batch_size = None):
+    '''
+    Non-parametric trends are more robust than linear regressions for autocorrelated and non-normal data. Pairwise differences are calculated for groups of series (batches) at a time, so memory use is bounded by the batch size. If the data array is dask backed, chunks along the remaining dimensions are processed in parallel (e.g., use arr.chunk({'time': -1, 'yt_ocean': 100}) to use all cores).
+    
+    Inputs:
+    arr - data array containing the dependent variable. Trends are calculated along dim for every combination of 
+    the remaining dimensions (e.g., for every grid cell)
+    dim - dimension along which trends are calculated. Default is 'time'
+    x - independent variable. If not given, years are used if dim contains dates, otherwise the values of dim are used
+    batch_size - number of series processed at once. If not given, it is set so about 10 million pairwise differences
+    are kept in memory at a time
+        
+    Output:
+    Dataset containing Sen's slope (slope) and intercept, Mann-Kendall S statistic (S), its variance corrected for ties 
+    (var_s), Z score (Z) and two sided p value (p_val), lag-1 autocorrelation of the detrended series (r1), and Z score 
+    and p value after correcting the variance of S for lag-1 autocorrelation (Z_corr, p_val_corr) following 
+    Yue and Wang (2004) [DOI:10.1023/B:WARM.0000043140.61082.60]
+    '''
+    
+    x = trendX(arr, dim, x).values
+    n = len(x)
+    if batch_size is None:
+        batch_size = max(1, int(1e7//max(1, n*(n-1)//2)))
+    names = ['slope', 'intercept', 'S', 'var_s', 'Z', 'p_val', 'r1', 'Z_corr', 'p_val_corr']
+    
+    #All values of a series must be in the same chunk
+    if arr.chunks is not None:
+        arr = arr.chunk({dim: -1})
+    
+    def _sen(y):
+        lead = y.shape[:-1]
+        y = y.reshape(-1, n)
+        out = np.full((len(names), y.shape[0]), np.nan)
+        for b0 in range(0, y.shape[0], batch_size):
+            out[:, b0:b0+batch_size] = senKernel(y[b0:b0+batch_size], x)
+        return tuple(o.reshape(lead) for o in out)
+    
+    out = xr.apply_ufunc(_sen, arr, input_core_dims = [[dim]], output_core_dims = [[]]*len(names), 
+                         dask = 'parallelized', output_dtypes = [np.float64]*len(names))
+    ds = xr.Dataset(dict(zip(names, out)))
+    
+    return ds
+
+########
+#Sen's slope and Mann-Kendall calculations for a group of series
+def senKernel(y, x):
+    '''
+    Inputs:
+    y - two dimensional numpy array with one series per row
+    x - one dimensional numpy array containing the independent variable
+        
+    Output:
+    Numpy array with one row per statistic (see senTrends) and one column per series
+    '''
+    c, n = y.shape
+    i, j = np.triu_indices(n, 1)
+    dx = x[j]-x[i]
+    dy = y[:, j]-y[:, i]
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category = RuntimeWarning)
+        #Sen's slope is the median of slopes between all pairs of values
+        slope = np.nanmedian(np.where(dx != 0, dy/np.where(dx != 0, dx, 1), np.nan), axis = 1)
+        intercept = np.nanmedian(y-slope[:, np.newaxis]*x, axis = 1)
+        #Mann-Kendall S statistic
+        S = np.nansum(np.sign(dy)*np.sign(dx), axis = 1)
+        del dy
+        
+        #Variance of S corrected for ties. Sorted values are split into groups of equal values
+        nv = (~np.isnan(y)).sum(axis = 1)
+        srt = np.sort(y, axis = 1)
+        start = np.ones(srt.shape, dtype = bool)
+        start[:, 1:] = srt[:, 1:] != srt[:, :-1]
+        group = np.cumsum(start, axis = 1)-1+(np.arange(c)*n)[:, np.newaxis]
+        t = np.bincount(group[~np.isnan(srt)], minlength = c*n)
+        ties = np.bincount(np.arange(c*n)//n, weights = t*(t-1)*(2*t+5), minlength = c)
+        var_s = (nv*(nv-1)*(2*nv+5)-ties)/18
+        var_s = np.where(nv > 2, var_s, np.nan)
+        Z = np.where(S > 0, S-1, np.where(S < 0, S+1, 0))/np.sqrt(var_s)
+        p_val = 2*ss.norm.sf(np.abs(Z))
+        
+        #Lag-1 autocorrelation of detrended series
+        res = y-slope[:, np.newaxis]*x
+        res = res-np.nanmean(res, axis = 1, keepdims = True)
+        r1 = np.nansum(res[:, 1:]*res[:, :-1], axis = 1)/np.nansum(res**2, axis = 1)
+        #Correction factor for the variance of S (n/n*)
+        k = np.arange(1, n)
+        cf = 1+2*np.nansum(np.where(k < nv[:, np.newaxis], (1-k/nv[:, np.newaxis])*r1[:, np.newaxis]**k, 0), axis = 1)
+        cf = np.maximum(cf, 1e-6)
+        Z_corr = Z/np.sqrt(cf)
+        p_corr = 2*ss.norm.sf(np.abs(Z_corr))
+    
+    S = np.where(nv > 1, S, np.nan)
+    
+    return np.stack([slope, intercept, S, var_s, Z, p_val, r1, Z_corr, p_corr])
+
 ########
 #This function calculates anomalies 
-def AnomCalc(array, clim_array, std_anom = False):
+def AnomCalc(array, clim_array, std_anom = False, path_out = None, time_chunk = 365):
     '''
     Inputs:
     array - refers to a data array containing information for the period being compared to the baseline. It could include just one year or multiple years (decades)
-    clim_array - three dimensional array containing data over the baseline period from which anomalies will be calculated
+    clim_array - three dimensional array containing data over the baseline period from which anomalies will be calculated. It can also be a climatology store (see climStoreAdd), in which case mean and standard deviation are taken from the store and anomalies are calculated per season or month if the store is seasonal or monthly. If a daily climatology is given (see climCalc), anomalies are calculated for each day of the year
     std_anom - boolean variable that if set to True will result in standarised anomalies being calculated
+    path_out - optional file path to a zarr store. If provided, baseline statistics are calculated once and anomalies are calculated and saved one time chunk at a time, so only one chunk is kept in memory
+    time_chunk - number of time steps calculated and saved at a time when path_out is provided. Default is 365
       
     Outputs:
-    Data array containing anomalies.
+    Data array containing anomalies. If path_out is provided, anomalies are loaded lazily from the zarr store.
     '''
     
+    #Daily climatology (see climCalc)
+    if 'dayofyear' in clim_array.dims:
+        if std_anom == True:
+            raise ValueError('Standarised anomalies cannot be calculated from a daily climatology')
+        if isinstance(clim_array, xr.Dataset):
+            clim_array = clim_array['mean']
+        group, m_climarray, s_climarray = 'daily', clim_array, None
+    #Mean and standard deviation from climatology store
+    elif isinstance(clim_array, xr.Dataset):
+        stats = climStoreStats(clim_array)
+        group = {'seasonal': 'time.season', 'monthly': 'time.month'}.get(clim_array.attrs['clim_type'])
+        m_climarray, s_climarray = stats['mean'], stats['std']
     #Calculate long term mean of array
-    m_climarray = clim_array.mean('time')
-      
-    #Calculate anomalies
-    #Standarised anomalies
-    if std_anom == True:
-        s_climarray = clim_array.std('time')
-        anom = (array - m_climarray)/s_climarray
-    #Non-standarised anomalies
-    elif std_anom == False:
-        anom = array - m_climarray
+    else:
+        group = None
+        m_climarray = clim_array.mean('time')
+        s_climarray = clim_array.std('time') if std_anom == True else None
+        
+    def _anom(array):
+        if group == 'daily':
+            return dailyAnom(array, m_climarray)
+        #Calculate anomalies
+        elif group is None:
+            anom = array - m_climarray
+            #Standarised anomalies
+            if std_anom == True:
+                anom = anom/s_climarray
+        #Calculate anomalies per season or month
+        else:
+            anom = array.groupby(group) - m_climarray
+            if std_anom == True:
+                anom = anom.groupby(group)/s_climarray
+            anom = anom.drop_vars(['season', 'month'], errors = 'ignore')
+        return anom
+    
+    if path_out is None:
+        #Return anomalies
+        return _anom(array)
+    
+    #Baseline statistics are calculated only once
+    m_climarray = m_climarray.compute()
+    if s_climarray is not None:
+        s_climarray = s_climarray.compute()
+    
+    #Anomalies are calculated and saved one time chunk at a time. Results are written to a temporary folder first so 
+    #interrupted writes are not used
+    name = array.name if array.name is not None else 'anomaly'
+    shutil.rmtree(path_out + '.tmp', ignore_errors = True)
+    for i in range(0, array.sizes['time'], time_chunk):
+        anom = _anom(array.isel(time = slice(i, i+time_chunk))).compute()
+        ds = anom.to_dataset(name = name)
+        for v in ds.variables:
+            ds[v].encoding = {}
+        if i == 0:
+            ds.to_zarr(path_out + '.tmp', mode = 'w', 
+                       encoding = {name: {'chunks': [time_chunk if d == 'time' else anom.sizes[d] for d in anom.dims]}})
+        else:
+            ds.to_zarr(path_out + '.tmp', append_dim = 'time')
+    shutil.rmtree(path_out, ignore_errors = True)
+    os.replace(path_out + '.tmp', path_out)
     
-    #Return anomalies
-    return anom
+    return xr.open_zarr(path_out)[name]
 
 
 ########
@@ -454,7 +1153,51 @@ def colbarRange(dict_data, sector, season):
 
 
 ########
-def SeaIceAdvArrays(array, thres = 0.15, ndays = 5, **kwargs):
+#Fills missing days in daily observations, so the record includes every day in the period covered
+def fillDailyGaps(array, max_gap = 1, clim = None):
+    '''
+    Inputs:
+    array - Data array with daily observations where some days may be missing.
+    max_gap - Maximum number of consecutive missing days that are linearly interpolated from the days before and after 
+    the gap. Default is 1.
+    clim - Optional. Daily climatology (see climCalc with clim_type = 'daily') used to fill values on missing days that were 
+    not interpolated (e.g., gaps longer than max_gap).
+    
+    Output:
+    Data array including all days between the first and last time steps, and a data array with the same dimensions 
+    flagging how each value was obtained: 0 for observed days, 1 for interpolated values, 2 for values filled with the 
+    climatology and -1 for values that remain missing. Flags are set per pixel, so a pixel on a missing day can remain 
+    missing (e.g., no observations on either side of the gap) while other pixels on that day are filled. If array is 
+    dask backed, results are not calculated until needed.
+    '''
+    #Complete daily calendar
+    time = pd.date_range(array.indexes['time'].min(), array.indexes['time'].max(), freq = 'D')
+    missing = xr.DataArray(~time.isin(array.indexes['time']), dims = 'time', coords = {'time': time})
+    full = array.reindex(time = time)
+    
+    #Linear interpolation of missing days. Gap length is measured between observed days before and after the gap
+    if full.chunks is not None:
+        full = full.chunk({'time': -1})
+    interp = full.interpolate_na('time', method = 'linear', max_gap = pd.Timedelta(days = max_gap+1))
+    #Only missing days are filled, other missing values in observations are not changed
+    filled = full.where(~missing, interp)
+    #Flags are based on values actually filled in each pixel
+    flag = xr.where(missing, xr.where(filled.notnull(), 1, -1), 0).transpose(*filled.dims)
+    
+    #Values still missing are filled with climatology
+    if clim is not None and missing.values.any():
+        if isinstance(clim, xr.Dataset):
+            clim = clim['mean']
+        slot = xr.DataArray(dailySlot(filled).values[missing.values], dims = 'time', 
+                            coords = {'time': time[missing.values]})
+        fill = clim.isel(dayofyear = slot).drop_vars('dayofyear')
+        filled = filled.combine_first(fill).transpose(*filled.dims)
+        flag = xr.where((flag == -1) & filled.notnull(), 2, flag)
+    
+    return filled, flag.astype('int8').rename('filled')
+
+########
+def SeaIceAdvArrays(array, thres = 0.15, ndays = 5, time_chunk = 30, **kwargs):
     '''
     The SeaIceAdvArrays was losely based on the `calc_ice_season` function from the `aceecostats` R package developed by Michael Sumner at AAD. This function calculates annual sea ice advance, retreat and total sea ice season duration as defined by Massom et al 2013 [DOI:10.1371/journal.pone.0064756].
     Briefly, if sea ice concentration in any pixel is at least 15% over five consecutive days, sea ice is considered to be advancing. Sea ice is retreating when its concentration is below 15% in any pixel until the end of the sea ice year. Sea ice season duration is the period between day of advance and retreat. Sea ice year is between February 15 and February 14 the following year.
@@ -464,6 +1207,10 @@ def SeaIceAdvArrays(array, thres = 0.15, ndays = 5, **kwargs):
     dir_out is the file path to the folder where outputs should be saved.
     thres refers to the minimum sea ice concentration threshold. The default is set to 0.15
     ndays is the minimum amount of consecutive days sea ice must be above threshold to be classified as advancing. Default set to 5
+    time_chunk is the number of days loaded into memory at once. Default set to 30
+    tile_size is optional. A dictionary with the number of pixels per tile along each spatial dimension (e.g., {'yt_ocean': 100, 'xt_ocean': 400}). If given, tiles are processed in parallel (see `SeaIceScanTiled`)
+    n_workers is optional. Number of local processes used to process tiles when no dask client is available
+    client is optional. Dask distributed client used to process tiles
     
     Outputs:
     Function saves three data arrays as netcdf files: advance, retreat and season duration. Data arrays can also be saved as variables in the notebook.
@@ -477,73 +1224,15 @@ def SeaIceAdvArrays(array, thres = 0.15, ndays = 5, **kwargs):
     array = array.sel(time = slice(f'{MinY}-02-15', f'{MaxY}-02-14'))
     
     ########
-    #Preparing masks to perform calculations on areas of interest only
-    #Calculate timesteps in dataset (365 or 366 depending on whether it was a leap year or not)
-    timesteps = len(array.time.values)
-
-    #Identify pixels (or cells) where sea ice concentration values are equal or above the threshold
-    #Resulting data array is boolean. If condition is met then pixel is set to True, otherwise set to False
-    threshold = xr.where(array >= thres, True, False)
-
-    #Creating masks based on time over threshold
-    #Add values through time to get total of days with ice cover of at least 15% within a pixel
-    rsum = threshold.sum('time')
-
-    #Boolean data arrays for masking
-    #If the total sum is zero, then set pixel to be True, otherwise set to False. 
-    #This identifies pixels where minimum sea ice concentration was never reached.
-    noIce = xr.where(rsum == 0, True, False)
-    #If the total sum is less than the minimum days, then set pixel to be True, otherwise set to False. 
-    #This identifies pixels where sea ice coverage did not meet the minimum consecutive days requirement.
-    noIceAdv = xr.where(rsum < ndays, True, False)
-    #If the total sum is the same as the timesteps, then set pixel to be True, otherwise set to False.
-    #This identifies pixels where sea ice concentration was always at least 15%
-    alwaysIce = xr.where(rsum == timesteps, True, False)
-    #Remove unused variables
-    del rsum
-
-    ########
-    #Sea ice advance calculations
-    #Use cumulative sums based on time. If pixel has sea ice cover below threshold, 
-    #then cumulative sum is reset to zero
-    adv = threshold.cumsum(dim = 'time')-threshold.cumsum(dim = 'time').\
-    where(threshold == 0).ffill(dim = 'time').fillna(0)
-    #Note: ffill adds nan values forward over a specific dimension
-
-    #Find timestep (date) where the minimum consecutive sea ice concentration was first 
-    #detected for each pixel
-    #Change all pixels that do not meet the minimum consecutive sea ice concentration to False. 
-    #Otherwise maintain their value.
-    advDate = xr.where(adv == ndays, adv, False)
-    #Find the time step index where condition above was met.
-    advDate = advDate.argmax(dim = 'time')
-    #Apply masks of no sea ice advance and sea ice always present.
-    advDate = advDate.where(noIceAdv == False, np.nan).where(alwaysIce == False, 1)
-    #Remove unused variables
-    del adv
-
-    ########
-    #Sea ice retreat calculations
-    #Reverse threshold data array (time wise) - So end date is now the start date and calculate 
-    #cumulative sum over time
-    ret = threshold[::-1].cumsum('time')
-    del threshold
-    #Change zero values to 9999 so they are ignored in the next step of our calculation
-    ret = xr.where(ret == 0, 9999, ret)
-    #Find the time step index where sea ice concentration change to above threshold.
-    retDate = ret.argmin(dim = 'time')
-    #Substract index from total time length
-    retDate = timesteps-retDate
-    #Apply masks of no sea ice over threshold and sea ice always over threshold.
-    retDate = retDate.where(noIce == False, np.nan).where(alwaysIce == False, timesteps)
-    #Remove unused variables
-    del ret
-    
-    ########
-    #Sea ice duration
-    durDays = retDate-advDate
-    #Remove unused variables
-    del noIce, noIceAdv, alwaysIce
+    #Calculating sea ice advance, retreat and duration in a single pass over time
+    if 'tile_size' in kwargs.keys():
+        #Split grid into tiles processed in parallel
+        advDate, retDate, durDays = SeaIceScanTiled(array, thres = thres, ndays = ndays, time_chunk = time_chunk,
+                                                    tile_size = kwargs.get('tile_size'), 
+                                                    n_workers = kwargs.get('n_workers'),
+                                                    client = kwargs.get('client'))
+    else:
+        advDate, retDate, durDays = SeaIceScan(array, thres = thres, ndays = ndays, time_chunk = time_chunk)
     
     ########
     #Adding a time dimension to newly created arrays and removing unused dimensions
@@ -574,34 +1263,294 @@ def SeaIceAdvArrays(array, thres = 0.15, ndays = 5, **kwargs):
         retpath = os.path.join(kwargs.get('dir_out'), (f'SeaIceRet_{MinY}-{MaxY}.nc'))
         durpath = os.path.join(kwargs.get('dir_out'), (f'SeaIceDur_{MinY}-{MaxY}.nc'))
     
-        #Save files simultaneously
-        xr.save_mfdataset(datasets = [advDate2.to_dataset(), 
-                                      retDate2.to_dataset(), 
-                                      durDate.to_dataset()], 
-                          paths = [advpath, retpath, durpath])
+        #Outputs are calculated together before saving, so the scan over time is only run once
+        advDate2, retDate2, durDate = dask.compute(advDate2, retDate2, durDate)
+        
+        #Save files simultaneously. Files are written to a temporary path first, so an interrupted run
+        #does not leave incomplete files behind
+        paths = [advpath, retpath, durpath]
+        #Outputs are days, so they are saved as integers
+        xr.save_mfdataset(datasets = [setEncoding(advDate2.to_dataset(), index = True), 
+                                      setEncoding(retDate2.to_dataset(), index = True), 
+                                      setEncoding(durDate.to_dataset(), index = True)], 
+                          paths = [f + '.tmp' for f in paths])
+        for f in paths:
+            os.replace(f + '.tmp', f)
     
     #Return data arrays as outputs
     return (advDate2, retDate2, durDate)
 
 
+########
+#Calculates sea ice seasonality for every sea ice year in a daily record, processing years in parallel
+def SeaIceAdvBatch(array, dir_out, thres = 0.15, ndays = 5, time_chunk = 30, n_workers = None, overwrite = False):
+    '''
+    The SeaIceAdvBatch function splits a daily sea ice concentration record (e.g., output of `getACCESSdata`) into sea ice years (February 15 to February 14 the following year) and applies `SeaIceAdvArrays` to each year in a process pool. Outputs for each year are saved as soon as that year is finished. Years whose outputs already exist and can be opened are skipped, so an interrupted job can be restarted and will continue where it stopped.
+    
+    Inputs:
+    array is the data array containing daily sea ice concentration for multiple years
+    dir_out is the file path to the folder where outputs will be saved
+    thres refers to the minimum sea ice concentration threshold. The default is set to 0.15
+    ndays is the minimum amount of consecutive days sea ice must be above threshold to be classified as advancing. Default set to 5
+    time_chunk is the number of days loaded into memory at once by each worker. Default set to 30
+    n_workers is the number of processes used. Default is the number of CPUs available. If set to 1, years are processed one at a time
+    overwrite is a boolean. If True, outputs for all years are calculated again even if they already exist. Default set to False
+    
+    Outputs:
+    Dictionary containing the file paths of advance, retreat and duration outputs for each sea ice year.
+    '''
+    
+    os.makedirs(dir_out, exist_ok = True)
+    tindex = array.indexes['time']
+    cal = getattr(tindex, 'calendar', 'standard')
+    
+    #Identify complete sea ice years in the record
+    jobs = {}
+    outputs = {}
+    for yr in range(tindex.year.min(), tindex.year.max()):
+        paths = [os.path.join(dir_out, f'SeaIce{k}_{yr}-{yr+1}.nc') for k in ['Adv', 'Ret', 'Dur']]
+        sub = array.sel(time = slice(f'{yr}-02-15', f'{yr+1}-02-14'))
+        
+        #Number of days expected in a sea ice year depends on the calendar used
+        #February 29 is included in sea ice years starting on leap years
+        if cal in ['noleap', '365_day']:
+            expected = 365
+        elif cal in ['all_leap', '366_day']:
+            expected = 366
+        elif cal == '360_day':
+            expected = 360
+        else:
+            expected = 366 if calendar.isleap(yr) else 365
+        if len(sub.time) != expected:
+            print(f'Sea ice year {yr}-{yr+1} is incomplete ({len(sub.time)} of {expected} days), skipping it.')
+            continue
+        
+        outputs[yr] = paths
+        #Skip years that were already processed
+        if overwrite == False and validSeaIceOutputs(paths):
+            continue
+        jobs[yr] = sub
+    
+    #Process years one at a time or in parallel
+    if n_workers == 1:
+        for yr, sub in jobs.items():
+            SeaIceAdvArrays(sub, thres = thres, ndays = ndays, time_chunk = time_chunk, dir_out = dir_out)
+    elif len(jobs) > 0:
+        with ProcessPoolExecutor(max_workers = n_workers) as pool:
+            futures = {pool.submit(SeaIceAdvArrays, sub, thres = thres, ndays = ndays, time_chunk = time_chunk, 
+                                   dir_out = dir_out): yr for yr, sub in jobs.items()}
+            for fut in as_completed(futures):
+                #Raise any errors found while processing a year
+                fut.result()
+    
+    return outputs
+
+########
+#Checks that sea ice seasonality outputs exist and can be opened
+def validSeaIceOutputs(paths):
+    '''
+    Inputs:
+    paths - list of file paths to sea ice advance, retreat and duration outputs
+    
+    Output:
+    Boolean. True if all files exist, can be opened and include one timestep, False otherwise.
+    '''
+    for f in paths:
+        if not os.path.isfile(f):
+            return False
+        try:
+            with xr.open_dataset(f) as ds:
+                if len(ds.data_vars) == 0 or ds.sizes.get('time') != 1:
+                    return False
+        except Exception:
+            return False
+    return True
+
+########
+#Calculates sea ice advance, retreat and duration walking through time in chunks
+def SeaIceScan(array, thres = 0.15, ndays = 5, time_chunk = 30):
+    '''
+    The SeaIceScan function reads one chunk of days at a time and only keeps a small state per pixel: the length of the current run of days above threshold, the first day a run reached the minimum number of consecutive days, the last day above threshold and the total number of days above threshold. Memory use is bounded by the grid size times the chunk size, regardless of the length of the time series.
+    
+    Inputs:
+    array is the data array on which sea ice seasonality calculations will be performed. It should only include one sea ice year
+    thres refers to the minimum sea ice concentration threshold. The default is set to 0.15
+    ndays is the minimum amount of consecutive days sea ice must be above threshold to be classified as advancing. Default set to 5
+    time_chunk is the number of days loaded into memory at once. Default set to 30
+    
+    Outputs:
+    Three data arrays: day of advance, day of retreat and sea ice season duration (as indices from the start of the sea ice year).
+    '''
+    
+    #Template for outputs: same spatial dimensions and coordinates as input without time
+    template = array.isel(time = 0, drop = True)
+    template.attrs = {}
+    
+    #Time must be the first dimension so chunks can be read one at a time
+    advDate, retDate, durDays = SeaIceKernel(array.transpose('time', *template.dims), thres = thres, 
+                                             ndays = ndays, time_chunk = time_chunk)
+    
+    #Create data arrays with the same coordinates as the input
+    advDate = template.copy(data = advDate)
+    retDate = template.copy(data = retDate)
+    durDays = template.copy(data = durDays)
+    
+    return advDate, retDate, durDays
+
+########
+#Sea ice seasonality calculations on an array where time is the first dimension
+def SeaIceKernel(values, thres = 0.15, ndays = 5, time_chunk = 30):
+    '''
+    Inputs:
+    values is a numpy or data array with time as its first dimension. Chunks of time_chunk days are loaded one at a time
+    thres refers to the minimum sea ice concentration threshold. The default is set to 0.15
+    ndays is the minimum amount of consecutive days sea ice must be above threshold to be classified as advancing. Default set to 5
+    time_chunk is the number of days loaded into memory at once. Default set to 30
+    
+    Outputs:
+    Three numpy arrays: day of advance, day of retreat and sea ice season duration.
+    '''
+    
+    #Calculate timesteps in dataset (365 or 366 depending on whether it was a leap year or not)
+    timesteps = values.shape[0]
+    shape = values.shape[1:]
+    
+    #Initialising state of each pixel
+    run = np.zeros(shape, dtype = np.int32)
+    count = np.zeros(shape, dtype = np.int32)
+    advIdx = np.full(shape, -1, dtype = np.int32)
+    lastIdx = np.full(shape, -1, dtype = np.int32)
+    
+    for t0 in range(0, timesteps, time_chunk):
+        #Identify pixels where sea ice concentration values are equal or above the threshold
+        threshold = np.asarray(values[t0:t0+time_chunk]) >= thres
+        
+        #Add values through time to get total of days with ice cover of at least 15% within a pixel
+        count += threshold.sum(axis = 0, dtype = np.int32)
+        
+        #Last day where sea ice was above threshold (index of first True in reversed chunk)
+        anyIce = threshold.any(axis = 0)
+        lastIdx = np.where(anyIce, t0+len(threshold)-1-threshold[::-1].argmax(axis = 0), lastIdx)
+        
+        #Length of consecutive runs above threshold. Cumulative sum is reset to zero when sea ice is below 
+        #threshold and runs continuing from the previous chunk are carried over
+        csum = threshold.cumsum(axis = 0, dtype = np.int32)
+        adv = csum-np.maximum.accumulate(np.where(threshold, 0, csum), axis = 0)
+        adv += np.where(csum == np.arange(1, len(threshold)+1).reshape((-1,)+(1,)*run.ndim), run, 0)
+        run = adv[-1]
+        del csum
+        
+        #First timestep (date) where the minimum consecutive sea ice concentration was detected
+        advHit = adv == ndays
+        newAdv = (advIdx < 0) & advHit.any(axis = 0)
+        advIdx = np.where(newAdv, t0+advHit.argmax(axis = 0), advIdx)
+        del threshold, adv, advHit
+    
+    #Boolean arrays for masking
+    #This identifies pixels where minimum sea ice concentration was never reached.
+    noIce = count == 0
+    #This identifies pixels where sea ice coverage did not meet the minimum consecutive days requirement.
+    noIceAdv = count < ndays
+    #This identifies pixels where sea ice concentration was always at least 15%
+    alwaysIce = count == timesteps
+    
+    ########
+    #Sea ice advance calculations
+    #Pixels with enough days above threshold, but not consecutive, are given the first timestep
+    advDate = np.where(advIdx < 0, 0, advIdx).astype(np.float64)
+    #Apply masks of no sea ice advance and sea ice always present.
+    advDate = np.where(noIceAdv, np.nan, advDate)
+    advDate = np.where(alwaysIce, 1, advDate)
+    
+    ########
+    #Sea ice retreat calculations
+    #Day after the last day above threshold
+    retDate = (lastIdx+1).astype(np.float64)
+    #Apply masks of no sea ice over threshold and sea ice always over threshold.
+    retDate = np.where(noIce, np.nan, retDate)
+    retDate = np.where(alwaysIce, timesteps, retDate)
+    
+    ########
+    #Sea ice duration
+    durDays = retDate-advDate
+    
+    return advDate, retDate, durDays
+
+########
+#Calculates sea ice seasonality splitting the grid into tiles that are processed in parallel
+def SeaIceScanTiled(array, thres = 0.15, ndays = 5, time_chunk = 30, tile_size = {'yt_ocean': 100, 'xt_ocean': 400}, 
+                    n_workers = None, client = None):
+    '''
+    Each pixel is independent, so the grid is split into tiles including the full time axis. Tiles are sent to a dask cluster if a client is given or already running (e.g., a LocalCluster), otherwise they are processed by local worker processes. Memory used by each worker is limited by the tile size.
+    
+    Inputs:
+    array is the data array on which sea ice seasonality calculations will be performed. It should only include one sea ice year
+    thres refers to the minimum sea ice concentration threshold. The default is set to 0.15
+    ndays is the minimum amount of consecutive days sea ice must be above threshold to be classified as advancing. Default set to 5
+    time_chunk is the number of days loaded into memory at once within each tile. Default set to 30
+    tile_size is a dictionary with the number of pixels per tile along each spatial dimension. Default is 100 x 400 pixels
+    n_workers is the number of local processes used if no dask client is available. Default is the number of CPUs
+    client is a dask distributed client. If not given, a running client is used if there is one
+    
+    Outputs:
+    Three data arrays: day of advance, day of retreat and sea ice season duration (as indices from the start of the sea ice year).
+    '''
+    
+    #Use a running dask cluster if available
+    if client is None:
+        try:
+            from distributed import get_client
+            client = get_client()
+        except (ImportError, ValueError):
+            client = None
+    
+    template = array.isel(time = 0, drop = True)
+    template.attrs = {}
+    
+    if client is not None:
+        #Rechunk so every tile contains the full time axis
+        tiled = array.chunk({'time': -1, **tile_size})
+        def _kernel(x):
+            return SeaIceKernel(np.moveaxis(x, -1, 0), thres = thres, ndays = ndays, time_chunk = time_chunk)
+        advDate, retDate, durDays = xr.apply_ufunc(_kernel, tiled, input_core_dims = [['time']], 
+                                                   output_core_dims = [[], [], []], dask = 'parallelized',
+                                                   output_dtypes = [np.float64]*3)
+        return tuple(da.transpose(*template.dims).assign_attrs({}) for da in [advDate, retDate, durDays])
+    
+    #Otherwise, send tiles to local processes and place results in the full grid
+    tiles = [{}]
+    for dim, size in tile_size.items():
+        tiles = [dict(t, **{dim: slice(i, i+size)}) for t in tiles for i in range(0, template.sizes[dim], size)]
+    
+    outputs = [np.full(template.shape, np.nan) for i in range(3)]
+    with ProcessPoolExecutor(max_workers = n_workers) as pool:
+        futures = {pool.submit(SeaIceScan, array.isel(**t), thres = thres, ndays = ndays, 
+                               time_chunk = time_chunk): t for t in tiles}
+        for fut in as_completed(futures):
+            #Position of the tile within the full grid
+            idx = tuple(futures[fut].get(d, slice(None)) for d in template.dims)
+            for out, res in zip(outputs, fut.result()):
+                out[idx] = res.transpose(*template.dims).values
+    
+    advDate, retDate, durDays = [template.copy(data = out) for out in outputs]
+    
+    return advDate, retDate, durDays
+
+
 ########
 #Calculate the lat-lon coordinates from a dataset in source_crs - Function by Scott Wales
-def calculate_latlon_coords(da, source_crs, target_crs):
+def calculate_latlon_coords(da, source_crs, target_crs, **kwargs):
     '''
     Inputs:
     da - refers to a data array that needs to be reprojected. Dimensions containing spatial data should be labelled as x and y.
     source_crs - original CRS for data array spatial information. Should be provided as a string in the form of 'epsg:4326'.
     target_crs - CRS to which the data array will be transformed. Should be provided as a string in the form of 'epsg:4326'.
+    Optional:
+    Any arguments used by latlonGrid (dtype, block_rows, n_workers, grid_dir).
     '''
     
-    # Convert the 1d coordinates to 2d arrays covering the whole grid
-    X, Y = np.meshgrid(da.x, da.y)
-    
-    # Use proj to create a transformation from the source coordinates to lat/lon
-    trans = Transformer.from_crs(source_crs, target_crs)
-    
-    # Convert the 2d coordinates from the source to the target values
-    lat, lon = trans.transform(X, Y)
+    # Latitude and longitude for every grid cell, which are only calculated once per grid
+    lat, lon = latlonGrid(da.x.values, da.y.values, source_crs, target_crs, **kwargs)
     
     # Add the coordinates to the dataset
     da.coords['lat'] = (('y','x'), lat)
@@ -620,35 +1569,148 @@ def calculate_latlon_coords(da, source_crs, target_crs):
 
 ########
 #Calculate the lat-lon coordinates from a dataset in source_crs - Function by Scott Wales
-def reproject_latlon_coords(da, source_crs, target_crs):
+def reproject_latlon_coords(da, source_crs, target_crs, **kwargs):
     '''
     Inputs:
     da - refers to a data array that needs to be reprojected. Dimensions containing spatial data should be labelled as x and y.
     source_crs - original CRS for data array spatial information. Should be provided as a string in the form of 'epsg:4326'.
     target_crs - CRS to which the data array will be transformed. Should be provided as a string in the form of 'epsg:4326'.
+    Optional:
+    Any arguments used by latlonGrid (dtype, block_rows, n_workers, grid_dir).
     '''
     
-    # Convert the 1d coordinates to 2d arrays covering the whole grid
-    X, Y = np.meshgrid(da.x, da.y)
-       
-    # Convert the 2d coordinates from the source to the target values
-    lon, lat = transform(Proj(init = source_crs), Proj(init = target_crs), X, Y)
+    return calculate_latlon_coords(da, source_crs, target_crs, **kwargs)
+
+
+########
+#Calculates latitude and longitude for every cell of a projected grid. Results are saved, so they are calculated only once per grid
+def latlonGrid(x, y, source_crs, target_crs, dtype = 'float64', block_rows = 500, n_workers = None, grid_dir = GRID_DIR):
+    '''
+    Inputs:
+    x - Numpy array with x coordinates of the grid.
+    y - Numpy array with y coordinates of the grid.
+    source_crs - original CRS of the grid. Should be provided as a string in the form of 'epsg:3976'.
+    target_crs - CRS of latitude and longitude values. Should be provided as a string in the form of 'epsg:4326'.
+    dtype - Data type of results. Use 'float32' to halve memory use. Default is 'float64'.
+    block_rows - Number of grid rows transformed at a time. Default is 500.
+    n_workers - Number of threads used to transform blocks of rows in parallel. Default is None, which uses as many as 
+    available processors.
+    grid_dir - Folder where grids are saved. If None, grids are only kept in memory. Default is GRID_DIR.
     
-    # Add the coordinates to the dataset
-    da.coords['lat'] = (('y','x'), lat)
-    da.coords['lon'] = (('y','x'), lon)
+    Output:
+    Two dimensional (y, x) numpy arrays with latitude and longitude values.
+    '''
+    key = hashlib.sha1(f'{source_crs}{target_crs}{np.dtype(dtype)}{len(x)}{len(y)}'.encode())
+    key.update(np.ascontiguousarray(x, dtype = 'float64').tobytes())
+    key.update(np.ascontiguousarray(y, dtype = 'float64').tobytes())
+    key = key.hexdigest()
     
-    # And add standard metadata so the lat and lon get picked up by xesmf
-    da.coords['lat'].attrs['units'] = 'degrees_north'
-    da.coords['lon'].attrs['units'] = 'degrees_east'
-    da.coords['lat'].attrs['axis'] = 'Y'
-    da.coords['lon'].attrs['axis'] = 'X'
-    da.coords['lat'].attrs['standard_name'] = 'latitude'
-    da.coords['lon'].attrs['standard_name'] = 'longitude'
+    if key in LATLON.keys():
+        return LATLON[key]
     
-    return da
+    grid_path = None if grid_dir is None else os.path.join(grid_dir, f'latlon_{key}.nc')
+    if grid_path is not None and os.path.isfile(grid_path):
+        with xr.open_dataset(grid_path) as grid:
+            lat, lon = grid.lat.values, grid.lon.values
+        lat.flags.writeable = False
+        lon.flags.writeable = False
+        LATLON[key] = (lat, lon)
+        return LATLON[key]
+    
+    lat = np.empty((len(y), len(x)), dtype = dtype)
+    lon = np.empty((len(y), len(x)), dtype = dtype)
+    
+    def _rows(start):
+        #Transformers cannot be shared across threads, so one is created per thread and CRS pair
+        tkey = (source_crs, target_crs, threading.get_ident())
+        if tkey not in TRANSFORMERS.keys():
+            TRANSFORMERS[tkey] = Transformer.from_crs(source_crs, target_crs, always_xy = True)
+        X, Y = np.meshgrid(x, y[start:start+block_rows])
+        lon[start:start+block_rows], lat[start:start+block_rows] = TRANSFORMERS[tkey].transform(X, Y)
+    
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        list(executor.map(_rows, range(0, len(y), block_rows)))
+    
+    if grid_path is not None:
+        os.makedirs(grid_dir, exist_ok = True)
+        grid = xr.Dataset({'lat': (('y', 'x'), lat), 'lon': (('y', 'x'), lon)}, coords = {'x': x, 'y': y})
+        setEncoding(grid, packing = None).to_netcdf(grid_path + '.tmp')
+        os.replace(grid_path + '.tmp', grid_path)
+    #Grids are shared by all arrays using them, so they are made read only
+    lat.flags.writeable = False
+    lon.flags.writeable = False
+    LATLON[key] = (lat, lon)
+    
+    return LATLON[key]
 
 
+########
+#Creates a regridder, which is saved to disk and reused for any data on the same grids
+def getRegridder(ds_in, ds_out, method = 'bilinear', weights_dir = WEIGHTS_DIR, **kwargs):
+    '''
+    Inputs:
+    ds_in - Data array or dataset on the source grid. Coordinates should be labelled as lat and lon (see calculate_latlon_coords).
+    ds_out - Data array or dataset on the target grid.
+    method - Regridding method used by xesmf. Default is 'bilinear'.
+    weights_dir - Folder where regridding weights are saved. Default is WEIGHTS_DIR.
+    Optional:
+    Any other arguments used by xesmf.Regridder (e.g., periodic, extrap_method).
+    
+    Output:
+    xesmf regridder. Weights are identified by the contents of both grids, the method and any other arguments, so 
+    they are only calculated the first time a combination is used.
+    '''
+    #Weights are identified by coordinate values (excluding time) and mask of both grids
+    key = hashlib.sha1(json.dumps({'method': method, **kwargs}, sort_keys = True, default = str).encode())
+    for grid in [ds_in, ds_out]:
+        names = sorted(grid.coords)
+        if isinstance(grid, xr.Dataset) and 'mask' in grid.keys():
+            names.append('mask')
+        for c in names:
+            if 'time' not in grid[c].dims:
+                key.update(f'{c}{grid[c].dims}'.encode())
+                key.update(np.ascontiguousarray(grid[c].values).tobytes())
+    key = key.hexdigest()
+    
+    if key not in REGRIDDERS.keys():
+        weights_path = os.path.join(weights_dir, f'{key}.nc')
+        if os.path.isfile(weights_path):
+            regridder = xe.Regridder(ds_in, ds_out, method, filename = weights_path, reuse_weights = True, **kwargs)
+        else:
+            #Weights are written to a temporary file first so interrupted writes are not used
+            os.makedirs(weights_dir, exist_ok = True)
+            regridder = xe.Regridder(ds_in, ds_out, method, filename = weights_path + '.tmp', **kwargs)
+            os.replace(weights_path + '.tmp', weights_path)
+        REGRIDDERS[key] = regridder
+    
+    return REGRIDDERS[key]
+
+########
+#Regrids data using saved regridding weights, processing time chunks in parallel
+def regridData(da, ds_out, method = 'bilinear', time_chunk = None, weights_dir = WEIGHTS_DIR, **kwargs):
+    '''
+    Inputs:
+    da - Data array to be regridded. Coordinates should be labelled as lat and lon (see calculate_latlon_coords).
+    ds_out - Data array or dataset on the target grid.
+    method - Regridding method used by xesmf. Default is 'bilinear'.
+    time_chunk - Number of time steps regridded at a time. Chunks are processed in parallel with dask. Default is 
+    None, which keeps existing chunks.
+    weights_dir - Folder where regridding weights are saved. Default is WEIGHTS_DIR.
+    Optional:
+    Any other arguments used by xesmf.Regridder (e.g., periodic, extrap_method).
+    
+    Output:
+    Regridded data array.
+    '''
+    regridder = getRegridder(da, ds_out, method, weights_dir, **kwargs)
+    
+    #Spatial dimensions cannot be split in chunks
+    if time_chunk is not None and 'time' in da.dims:
+        spatial = set(da['lat'].dims).union(da['lon'].dims)
+        da = da.chunk(dict([(d, -1) for d in spatial], time = time_chunk))
+    
+    return regridder(da)
+
 ########
 #Calculating climatology
 def climCalc(da, clim_period, varname, clim_type = 'overall', **kwargs):
@@ -657,12 +1719,23 @@ def climCalc(da, clim_period, varname, clim_type = 'overall', **kwargs):
     da - data array, containing information from which a climatology will be calculated
     clim_period - list, time frame to be used in climatology calculation. Only start and end year are needed.
     clim_type - str, what type of climatology needs to be calculated. Default is 'overall', also available
-        'seasonal' and 'monthly'.
+        'seasonal', 'monthly' and 'daily'.
     Optional:
     folder_out - str, containing file path to folder where results will be stored.
+    store - dataset or str, climatology store (see climStoreAdd) or file path to a store saved as netcdf. Years 
+        already included in the store are not read again, years within clim_period missing from the store are added 
+        and years outside clim_period are removed without reading their data again. If a file path is given, the 
+        updated store is saved to it. Not used for daily climatologies.
+    window - int, only for daily climatologies. Number of days (odd number) centred on each day of the year that 
+        are pooled to calculate the climatology. Default is 1 (no smoothing).
+    percentiles - list, only for daily climatologies. Percentiles (0-100) to be calculated for each day of the year 
+        (e.g., thresholds for marine heatwaves).
+    chunks - dictionary, only for daily climatologies. Size of the spatial chunks (e.g., {'yt_ocean': 50, 
+        'xt_ocean': 100}) processed at a time.
    
     Outputs:
-    clim - data array containing the calculated climatology
+    clim - data array containing the calculated climatology. Daily climatologies include 366 days (Feb 29 is day 60 
+        in all years). If percentiles are calculated, a dataset including the mean and percentiles is returned.
     '''
     
     #Ensuring time period is a string
@@ -671,8 +1744,37 @@ def climCalc(da, clim_period, varname, clim_type = 'overall', **kwargs):
     #Select data within climatology period
     clim = da.sel(time = slice(*clim_period))
 
-    #Calculating climatology
-    if clim_type == 'overall':
+    #Calculating daily climatology
+    if clim_type == 'daily':
+        clim = dailyClim(clim, window = kwargs.get('window', 1), percentiles = kwargs.get('percentiles', None), 
+                         chunks = kwargs.get('chunks', None))
+        fn = varname + f'_Climatology_daily_{clim_period[0]}-{clim_period[1]}.nc'
+    #Calculating climatology from the store, which is only updated with years that have changed
+    elif 'store' in kwargs.keys():
+        store = kwargs.get('store')
+        store_path = store if isinstance(store, str) else None
+        if store_path is not None:
+            store = xr.open_dataset(store_path).load() if os.path.isfile(store_path) else None
+        if store is not None and store.attrs['clim_type'] != clim_type:
+            raise ValueError(f"Store contains a {store.attrs['clim_type']} climatology, not {clim_type}")
+        if store is not None and 'year' not in store.dims:
+            raise ValueError('Store does not include sums per year, it must be created again')
+        period = np.arange(int(clim_period[0]), int(clim_period[1])+1)
+        stored = [] if store is None else store['year'].values.tolist()
+        #Removing years outside the climatology period, raw data for these years is not needed
+        old_yrs = [yr for yr in stored if yr not in period]
+        if len(old_yrs) > 0:
+            store = climStoreRemove(store, old_yrs)
+        #Adding years missing from the store
+        new_yrs = [yr for yr in period if yr not in stored]
+        if len(new_yrs) > 0:
+            store = climStoreAdd(store, clim.sel(time = clim['time.year'].isin(new_yrs)), clim_type = clim_type)
+        if store_path is not None:
+            setEncoding(store, packing = None).to_netcdf(store_path + '.tmp')
+            os.replace(store_path + '.tmp', store_path)
+        clim = climStoreStats(store)['mean'].rename(da.name)
+        fn = varname + f'_Climatology_{clim_type}_{clim_period[0]}-{clim_period[1]}.nc'
+    elif clim_type == 'overall':
         clim = clim.mean('time')
         fn = varname + f'_Climatology_overall_{clim_period[0]}-{clim_period[1]}.nc'
     elif clim_type == 'seasonal':
@@ -688,10 +1790,238 @@ def climCalc(da, clim_period, varname, clim_type = 'overall', **kwargs):
         #Ensure output folder exists
         os.makedirs(out_folder, exist_ok = True)
         #Saving results to disk
-        clim.to_netcdf(os.path.join(out_folder, fn))
+        setEncoding(clim).to_netcdf(os.path.join(out_folder, fn))
         
     return clim
 
+########
+#Calculates a daily climatology, pooling data within a window centred on each day of the year
+def dailyClim(da, window = 1, percentiles = None, chunks = None):
+    '''
+    Inputs:
+    da - data array, containing daily data from which the climatology will be calculated
+    window - int, number of days (odd number) centred on each day of the year that are pooled to calculate the 
+        climatology. Windows include days at the end and start of the year. Default is 1 (no smoothing).
+    percentiles - list, percentiles (0-100) to be calculated for each day of the year. Default is None.
+    chunks - dictionary, size of spatial chunks processed at a time. Default is None (chunks in da are kept).
+    
+    Outputs:
+    clim - data array with the mean for each day of the year (dayofyear dimension from 1 to 366). If percentiles 
+        are given, a dataset with the mean and percentiles is returned.
+    '''
+    if window % 2 == 0:
+        raise ValueError('window must be an odd number of days')
+    q = [] if percentiles is None else list(np.atleast_1d(percentiles))
+    
+    #All time steps are needed for each cell, so data is only split in space
+    if chunks is not None or da.chunks is not None:
+        da = da.chunk(dict(chunks or {}, time = -1))
+    
+    clim = xr.apply_ufunc(dailyClimKernel, da, dailySlot(da), 
+                          kwargs = {'window': window, 'percentiles': q},
+                          input_core_dims = [['time'], ['time']], output_core_dims = [['dayofyear']], 
+                          dask = 'parallelized', output_dtypes = ['float64'],
+                          dask_gufunc_kwargs = {'output_sizes': {'dayofyear': 366*(1+len(q))}})
+    clim = clim.assign_coords(dayofyear = np.tile(np.arange(1, 367), 1+len(q)))
+    clim = clim.transpose('dayofyear', ...)
+    
+    if len(q) == 0:
+        return clim
+    
+    #Separating means and percentiles
+    clim = xr.Dataset({'mean': clim[:366], 
+                       'percentiles': xr.concat([clim[366*(i+1):366*(i+2)] for i in range(len(q))], 
+                                                dim = xr.DataArray(q, dims = 'percentile'))})
+    
+    return clim
+
+########
+#Identifies the day of the year of each time step using a 366 day year, so dates after February have the same day in all years
+def dailySlot(da):
+    '''
+    Inputs:
+    da - data array, containing a time dimension
+    
+    Outputs:
+    Data array with day of the year (from 0 to 365) for each time step. February 29 is always day 59.
+    '''
+    #First day of each month in a leap year
+    start = np.cumsum([0] + [calendar.monthrange(2000, m)[1] for m in range(1, 12)])
+    slot = start[da['time.month'].values-1] + da['time.day'].values - 1
+    
+    return xr.DataArray(slot, dims = 'time', coords = {'time': da.time})
+
+########
+#Calculates means (and percentiles) for each day of the year using a circular moving window
+def dailyClimKernel(values, slot, window = 1, percentiles = []):
+    '''
+    Inputs:
+    values - numpy array, with time as the last dimension
+    slot - numpy array, day of the year (from 0 to 365) of each time step
+    window - int, number of days (odd number) centred on each day of the year that are pooled
+    percentiles - list, percentiles (0-100) to be calculated
+    
+    Outputs:
+    Numpy array with means for each day of the year followed by each percentile as the last dimension
+    '''
+    slot = np.asarray(slot).ravel()
+    half = window//2
+    
+    #Sums and counts per day of the year
+    valid = ~np.isnan(values)
+    sums = np.zeros(values.shape[:-1] + (366,))
+    counts = np.zeros(values.shape[:-1] + (366,))
+    order = np.argsort(slot, kind = 'stable')
+    days, starts = np.unique(slot[order], return_index = True)
+    sums[..., days] = np.add.reduceat(np.where(valid, values, 0)[..., order], starts, axis = -1)
+    counts[..., days] = np.add.reduceat(valid[..., order].astype('float64'), starts, axis = -1)
+    
+    #Window sums using cumulative sums, including days at the end and start of the year
+    def _window(x):
+        x = np.concatenate([x[..., 366-half:], x, x[..., :half]], axis = -1)
+        x = np.cumsum(x, axis = -1)
+        x = np.concatenate([np.zeros(x.shape[:-1] + (1,)), x], axis = -1)
+        return x[..., window:] - x[..., :-window]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        out = [_window(sums)/_window(counts)]
+    
+    #Percentiles of data pooled within the window of each day
+    if len(percentiles) > 0:
+        pct = np.full(values.shape[:-1] + (366, len(percentiles)), np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for d in range(366):
+                in_window = np.isin(slot, np.arange(d-half, d+half+1) % 366)
+                if in_window.any():
+                    pct[..., d, :] = np.moveaxis(np.nanpercentile(values[..., in_window], percentiles, axis = -1), 0, -1)
+        out += [pct[..., i] for i in range(len(percentiles))]
+    
+    return np.concatenate(out, axis = -1)
+
+########
+#Calculates anomalies from a daily climatology without repeating the climatology over time
+def dailyAnom(array, clim):
+    '''
+    Inputs:
+    array - data array, containing daily data from which anomalies will be calculated
+    clim - data array, daily climatology (see dailyClim)
+    
+    Outputs:
+    Data array containing anomalies
+    '''
+    def _anom(values, clim, slot):
+        #Climatology for the day of the year of each time step, only for the block being processed
+        slot = slot[..., None]
+        ndim = max(clim.ndim, slot.ndim)
+        clim = clim.reshape((1,)*(ndim-clim.ndim) + clim.shape)
+        slot = slot.reshape((1,)*(ndim-slot.ndim) + slot.shape)
+        return values - np.take_along_axis(clim, slot, axis = -1)[..., 0]
+    
+    anom = xr.apply_ufunc(_anom, array, clim.chunk({'dayofyear': -1}) if clim.chunks is not None else clim, 
+                          dailySlot(array), input_core_dims = [[], ['dayofyear'], []], 
+                          dask = 'parallelized', output_dtypes = [array.dtype])
+    
+    return anom.transpose(*array.dims)
+
+########
+#Adds data to a climatology store, which keeps sums, sums of squares and counts per year so climatologies can be updated without recalculating them
+def climStoreAdd(store, da, clim_type = 'overall'):
+    '''
+    Inputs:
+    store - dataset, climatology store to be updated. If None, a new store is created.
+    da - data array, containing data for the years to be added to the store. Years must not be included in the store.
+    clim_type - str, what type of climatology the store keeps. Default is 'overall', also available 'seasonal' and 
+        'monthly'. Ignored if store is provided.
+        
+    Outputs:
+    store - dataset with sums, sums of squares and counts per year and cell (and per season or month). Values are 
+        stored as differences from a reference value (shift) to avoid loss of precision in sums of squares.
+    '''
+    years = sorted(set(da['time.year'].values.tolist()))
+    
+    if store is None:
+        #Reference values are the mean of the data used to create the store
+        shift = da.mean('time').fillna(0).astype('float64')
+    else:
+        if 'year' not in store.dims:
+            raise ValueError('Store does not include sums per year, it must be created again')
+        clim_type = store.attrs['clim_type']
+        shift = store['shift']
+        stored = store['year'].values.tolist()
+        if len(set(years).intersection(stored)) > 0:
+            raise ValueError(f'Years already included in store: {sorted(set(years).intersection(stored))}')
+    
+    #Sums are kept separately for each year, so years can be removed without reading data again
+    sums = xr.concat([climStoreSums(da.sel(time = da['time.year'] == yr), shift, clim_type) for yr in years], 
+                     dim = pd.Index(years, name = 'year'), fill_value = 0)
+    if store is not None:
+        sums = xr.concat([store[['sum', 'sum_sq', 'count']], sums], dim = 'year', fill_value = 0).sortby('year')
+    sums['shift'] = shift
+    sums.attrs = {'clim_type': clim_type}
+    
+    return sums
+
+########
+#Removes years from a climatology store
+def climStoreRemove(store, years):
+    '''
+    Inputs:
+    store - dataset, climatology store to be updated.
+    years - list, years to be removed from the store. Years must be included in the store.
+        
+    Outputs:
+    store - dataset with sums, sums of squares and counts after removing years
+    '''
+    stored = store['year'].values.tolist()
+    if not set(years).issubset(stored):
+        raise ValueError(f'Years not included in store: {sorted(set(years).difference(stored))}')
+    
+    return store.drop_sel(year = list(years))
+
+########
+#Calculates sums, sums of squares and counts used in a climatology store
+def climStoreSums(da, shift, clim_type = 'overall'):
+    '''
+    Inputs:
+    da - data array, containing data to be summarised
+    shift - data array, reference values subtracted from data before calculating sums
+    clim_type - str, 'overall', 'seasonal' or 'monthly'. Default is 'overall'
+        
+    Outputs:
+    Dataset with sums, sums of squares and counts
+    '''
+    diff = (da - shift).astype('float64')
+    sums = xr.Dataset({'sum': diff, 'sum_sq': diff**2, 'count': diff.notnull().astype('int64')})
+    
+    if clim_type == 'overall':
+        sums = sums.sum('time')
+    elif clim_type == 'seasonal':
+        sums = sums.groupby('time.season').sum('time')
+    elif clim_type == 'monthly':
+        sums = sums.groupby('time.month').sum('time')
+        
+    return sums
+
+########
+#Calculates mean and standard deviation from a climatology store
+def climStoreStats(store, ddof = 0):
+    '''
+    Inputs:
+    store - dataset, climatology store (see climStoreAdd)
+    ddof - int, delta degrees of freedom used to calculate standard deviation. Default is 0
+        
+    Outputs:
+    Dataset with mean and standard deviation. Cells without data are set to NaN
+    '''
+    #Adding sums from all years in the store
+    totals = store[['sum', 'sum_sq', 'count']].sum('year')
+    count = totals['count'].where(totals['count'] > 0)
+    mean = totals['sum']/count
+    var = (totals['sum_sq'] - totals['sum']*mean)/(count - ddof)
+    stats = xr.Dataset({'mean': mean + store['shift'], 'std': np.sqrt(var.clip(min = 0))}, attrs = store.attrs)
+    
+    return stats
+
 ########
 def main(inargs):
     '''Run the program.'''